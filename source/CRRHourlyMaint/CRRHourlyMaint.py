@@ -17,19 +17,29 @@
 from __future__ import print_function
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import calendar
 import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime,timedelta
 
 def getparm (parmname, defaultval):
-    try:
-        myval = os.environ[parmname]
-        if isinstance(defaultval, int):
-            return int(myval)
-        else:
-            return myval
-    except:
+    myval = os.environ.get(parmname)
+    if myval is None:
         print('Environmental variable \'' + parmname + '\' not found. Using default [' + str(defaultval) + ']')
         return defaultval
+    if isinstance(defaultval, int):
+        try:
+            return int(myval)
+        except ValueError:
+            print('Environmental variable \'' + parmname + '\' is not an integer. Using default [' + str(defaultval) + ']')
+            return defaultval
+    return myval
 #######################################################################
 # Check for incomplete transfers that started more than an hour ago.
 # - If it no longer exists, discard it
@@ -45,9 +55,48 @@ def getparm (parmname, defaultval):
 #
 ddbtable = getparm('appname', 'CRRMonitor')
 stattable = ddbtable + 'Statistics'
+# GSI on (incomplete_status, start_datetime), created by the template.
+# CRRMonitor sets incomplete_status (PENDING or FAILED) on first sight of
+# a source object and removes it on completion, so the index only holds
+# unfinished transfers.
+incomplete_index = 'IncompleteIdx'
+incomplete_statuses = [ 'PENDING', 'FAILED' ]
 timefmt = '%Y-%m-%dT%H:%M:%SZ'
 roundTo = getparm('roundTo', 300) # 5 minute buckets for CW metrics
 purge_thresh = getparm('purge_thresh', 24) # threshold in hours
+purge_batch = 25 # BatchWriteItem limit
+purge_retries = getparm('purge_retries', 5) # retries of unprocessed deletes
+stat_workers = getparm('stat_workers', 32) # parallel stats table updates
+item_workers = getparm('item_workers', 64) # parallel head_object/update_item
+# full_scan: Yes to also sweep the table for incomplete rows that are not
+# in the GSI (written before CRRMonitor set incomplete_status). Uses a
+# parallel scan with scan_segments segments.
+full_scan = getparm('full_scan', 'No')
+scan_segments = getparm('scan_segments', 8)
+page_queue_depth = getparm('page_queue_depth', 2) # pages read ahead of processing
+# client_config: the connection pool must be at least as large as the
+# number of worker threads sharing a client, or connections are discarded
+# and re-established on every call.
+client_config = Config(
+    max_pool_connections=max(item_workers, stat_workers) + len(incomplete_statuses) + scan_segments,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+)
+# tcp_keepalive needs botocore >= 1.27. Older versions reject the option;
+# they still reuse pooled HTTP/1.1 connections, just without TCP keep-alive.
+try:
+    client_config = client_config.merge(Config(tcp_keepalive=True))
+except TypeError:
+    print('botocore does not support tcp_keepalive - continuing without it')
+# Update expressions are fixed, so build them once rather than per item.
+# A COMPLETED row leaves IncompleteIdx; a FAILED one stays in it.
+ddb_update_exp = {
+    'COMPLETED': 'set s3Object = :a, replication_status = :b remove incomplete_status',
+    'FAILED': 'set s3Object = :a, replication_status = :b, incomplete_status = :b'
+}
+ddb_condition_exp = 'attribute_not_exists(replication_status) or replication_status <> :b'
+# Only these attributes are read by handle_item; IncompleteIdx projects them all
+item_projection = 'ETag, s3Origin, s3Object, start_datetime, replication_status'
+stat_update_exp = 'SET timebucket = :t, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
 client={
     's3': { 'service': 's3' },
     'ddb': { 'service': 'dynamodb'}
@@ -63,9 +112,9 @@ def connect_clients(clients_to_connect):
     for c in clients_to_connect:
         try:
             if 'region' in clients_to_connect[c]:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'])
+                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'], config=client_config)
             else:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'])
+                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], config=client_config)
         except Exception as e:
             print(e)
             print('Error connecting to ' + clients_to_connect[c]['service'])
@@ -81,149 +130,310 @@ def lambda_handler(event, context):
     # -----------------------------------------------------------------
     # purge_item - removes old items
     #
-    def purge_item(itemkey):
-        print('Purge ETag: ' + itemkey)
+    # ETags are queued in purge_buf and deleted purge_batch at a time
+    # with BatchWriteItem. flush_purges deletes whatever is left.
+    #
+    purge_buf = []
+    purge_lock = threading.Lock() # purge_item is called from handle_item threads
+
+    def delete_items(itemkeys):
+        request_items = {
+            ddbtable: [ { 'DeleteRequest': { 'Key': { 'ETag': { 'S': k } } } } for k in dict.fromkeys(itemkeys) ]
+        }
         try:
-            client['ddb']['handle'].delete_item(
-                TableName=ddbtable,
-                Key={
-                    'ETag': {
-                        'S': itemkey
-                    }
-                }
-            )
+            for attempt in range(purge_retries + 1):
+                response = client['ddb']['handle'].batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+                if not request_items:
+                    return
+                # Throttled - back off and retry only the unprocessed deletes
+                time.sleep(min(0.05 * (2 ** attempt), 2))
+            raise Exception(str(len(request_items[ddbtable])) + ' deletes still unprocessed')
         except Exception as e:
             print(e)
-            print('Error purging ' + itemkey + ' from ' + ddbtable)
+            print('Error purging ' + str(len(itemkeys)) + ' items from ' + ddbtable)
             raise e
+
+    def purge_item(itemkey):
+        print('Purge ETag: ' + itemkey)
+        with purge_lock:
+            purge_buf.append(itemkey)
+            if len(purge_buf) < purge_batch:
+                return
+            batch = purge_buf[:]
+            del purge_buf[:]
+        delete_items(batch)
+
+    def flush_purges():
+        with purge_lock:
+            batch = purge_buf[:]
+            del purge_buf[:]
+        if batch:
+            delete_items(batch)
+
     # -----------------------------------------------------------------
-    # log_statistics
+    # log_statistics - accumulate in stats_acc, keyed by statbucket.
+    # Nothing is written here; flush_statistics issues one update per
+    # statbucket with the summed increments.
     #
+    stats_acc = defaultdict(lambda: { 'objects': 0, 'size': 0, 'elapsed': 0 })
+    stats_lock = threading.Lock() # log_statistics is called from handle_item threads
+
     def log_statistics(Src,Dst,Tstamp,Size,ET,roundTo):
         # -------------------------------------------------------------
         # Derive the statistic bucket from source/dest and time bucket
         # (5 minute rolling window)
         #
+        # Tstamp is always timefmt (YYYY-MM-DDTHH:MM:SSZ), so slice out the
+        # fields and round the epoch seconds without building datetimes.
+        #
         statbucket=Src + ':' + Dst
-        ts = datetime.strptime(Tstamp, timefmt)
-        secs = (ts.replace(tzinfo=None) - ts.min).seconds
-        rounding = (secs+roundTo/2) // roundTo * roundTo
-        ts = ts + timedelta(0,rounding-secs,-ts.microsecond)
-        statbucket += ':' + datetime.strftime(ts, timefmt)
+        epoch = calendar.timegm((int(Tstamp[0:4]), int(Tstamp[5:7]), int(Tstamp[8:10]),
+                                 int(Tstamp[11:13]), int(Tstamp[14:16]), int(Tstamp[17:19]), 0, 0, 0))
+        rounded = (epoch + roundTo//2) // roundTo * roundTo
+        timebucket = time.strftime(timefmt, time.gmtime(rounded))
+        statbucket += ':' + timebucket
         # -------------------------------------------------------------
-        # Init a dict to use to hold our attrs for DDB
-        stat_exp_attrs = {}
-        # -------------------------------------------------------------
-        # Build the DDB UpdateExpression
-        stat_update_exp = 'SET timebucket = :t, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
-        # -------------------------------------------------------------
-        # push the first attr: s3Object
-        stat_exp_attrs[':a'] = { 'N': '1' }
-        stat_exp_attrs[':c'] = { 'N': Size }
-        stat_exp_attrs[':d'] = { 'N': ET }
-        stat_exp_attrs[':t'] = { 'S': datetime.strftime(ts, timefmt) }
-        stat_exp_attrs[':o'] = { 'S': Src }
-        stat_exp_attrs[':r'] = { 'S': Dst }
-        #print('s3Object: ' + key)
+        # Add to the running totals for this statbucket
+        with stats_lock:
+            stat = stats_acc[statbucket]
+            stat['objects'] += 1
+            stat['size'] += int(Size)
+            stat['elapsed'] += int(ET)
+            stat['timebucket'] = timebucket
+            stat['source_bucket'] = Src
+            stat['dest_bucket'] = Dst
+
+    # -----------------------------------------------------------------
+    # update_statistic - write one accumulated statbucket
+    #
+    def update_statistic(statbucket, stat):
+        stat_exp_attrs = {
+            ':a': { 'N': str(stat['objects']) },
+            ':c': { 'N': str(stat['size']) },
+            ':d': { 'N': str(stat['elapsed']) },
+            ':t': { 'S': stat['timebucket'] },
+            ':o': { 'S': stat['source_bucket'] },
+            ':r': { 'S': stat['dest_bucket'] }
+        }
         try:
-            client['ddb']['handle'].update_item(
+            ddb_update_item(
                 TableName = stattable,
                 Key = { 'OriginReplicaBucket': { 'S': statbucket } },
                 UpdateExpression = stat_update_exp,
-                ExpressionAttributeValues = stat_exp_attrs)
+                ExpressionAttributeValues = stat_exp_attrs,
+                ReturnValues = 'NONE')
         except Exception as e:
             print(e)
             print('Table ' + stattable + ' update failed')
             raise e
 
     # -----------------------------------------------------------------
-    # process_items - check each item returned by the scan
+    # flush_statistics - one update_item per statbucket, in parallel
+    #
+    def flush_statistics():
+        if not stats_acc:
+            return
+        with ThreadPoolExecutor(max_workers=stat_workers) as ex:
+            # list() so the first failed update is re-raised here
+            list(ex.map(lambda s: update_statistic(*s), stats_acc.items()))
+        stats_acc.clear()
+
+    # -----------------------------------------------------------------
+    # process_items - check each item returned by the scan. Items are
+    # independent, so handle_item runs on a thread pool.
     #
+    def handle_item(i):
+        # Call head-object to check replication status
+        try:
+            response = s3_head_object(
+                Bucket=i['s3Origin']['S'],
+                Key=i['s3Object']['S'])
+        except Exception as e:
+            print('Item no longer exists - purging: ' + i['ETag']['S'])
+            purge_item(i['ETag']['S'])
+            return
+        # Object still exists
+        headers = response['ResponseMetadata']['HTTPHeaders']
+
+        repstatus = headers.get('x-amz-replication-status')
+        # Items from IncompleteIdx carry their current status. If it has
+        # not changed the update would be a no-op, so skip the write.
+        if repstatus not in ('COMPLETED', 'FAILED') or \
+                i.get('replication_status', {}).get('S') == repstatus:
+            return
+
+        if repstatus == 'COMPLETED':
+            print('Completed transfer found: ' + i['ETag']['S'])
+        ddb_exp_attrs = {
+            ':a': { 'S': i['s3Object']['S'] },
+            ':b': { 'S': repstatus }
+        }
+
+        # Update the record in the DDB table. The condition covers a
+        # concurrent CRRMonitor write of the same status; in that case
+        # there is nothing to do, and a failure must not be counted twice.
+        try:
+            ddb_update_item(
+                TableName = ddbtable,
+                Key = { 'ETag': i['ETag'] },
+                UpdateExpression = ddb_update_exp[repstatus],
+                ConditionExpression = ddb_condition_exp,
+                ExpressionAttributeValues = ddb_exp_attrs,
+                ReturnValues = 'NONE')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return
+            print(e)
+            print('Table ' + ddbtable + ' update failed')
+            raise e
+        except Exception as e:
+            print(e)
+            print('Table ' + ddbtable + ' update failed')
+            raise e
+
+        if repstatus == 'FAILED':
+            log_statistics(i['s3Origin']['S'],'FAILED',i['start_datetime']['S'],'0','1',300)
+
     def process_items(items):
-        for i in items:
-
-            # Call head-object to check replication status
-            try:
-                response = client['s3']['handle'].head_object(
-                    Bucket=i['s3Origin']['S'],
-                    Key=i['s3Object']['S'])
-            except Exception as e:
-                print('Item no longer exists - purging: ' + i['ETag']['S'])
-                purge_item(i['ETag']['S'])
-                continue
-            # Init a dict to use to hold our attrs for DDB
-            ddb_exp_attrs = {}
-            # Build th e DDB UpdateExpression
-            ddb_update_exp = 'set s3Object = :a'
-            # push the first attr: s3Object
-            ddb_exp_attrs[':a'] = { 'S': i['s3Object']['S'] }
-
-            # Object still exists
-            headers = response['ResponseMetadata']['HTTPHeaders']
-
-            lastmod = datetime.strftime(response['LastModified'], timefmt)
-
-            if headers['x-amz-replication-status'] == 'COMPLETED':
-                print('Completed transfer found: ' + i['ETag']['S'])
-                ddb_update_exp += ', replication_status = :b'
-                ddb_exp_attrs[':b'] = { 'S': 'COMPLETED' }
-                #print(response)
-            elif headers['x-amz-replication-status'] == 'FAILED':
-                ddb_update_exp += ', replication_status = :b'
-                ddb_exp_attrs[':b'] = { 'S': 'FAILED' }
-                log_statistics(i['s3Origin']['S'],'FAILED',i['start_datetime']['S'],'0','1',300)
-
-            # Update the record in the DDB table
-            try:
-                client['ddb']['handle'].update_item(
-                    TableName = ddbtable,
-                    Key = { 'ETag': i['ETag'] },
-                    UpdateExpression = ddb_update_exp,
-                    ExpressionAttributeValues = ddb_exp_attrs)
-            except Exception as e:
-                print(e)
-                print('Table ' + ddbtable + ' update failed')
-                raise e
+        with ThreadPoolExecutor(max_workers=item_workers) as ex:
+            # list() so the first failed item is re-raised here
+            list(ex.map(handle_item, items))
 
     # -----------------------------------------------------------------
     # check_incompletes
     #
+    # Incomplete items are read from the IncompleteIdx GSI (hash key
+    # incomplete_status, range key start_datetime) rather than scanning
+    # the whole table. The index is sparse: it only has PENDING and FAILED
+    # rows.
+    #
+    # Each GSI partition (and each full_scan segment) is paged by its own
+    # producer thread. Pages are handed to this thread through a bounded
+    # queue, so the next page is being read while the current one is
+    # processed.
+    #
     print('Checking for incomplete transfers')
     check = datetime.utcnow() - timedelta(hours=1) # datetime object
     checkstr= check.strftime(timefmt) # string object
-    # Set scan filter attrs
-    eav = {
-        ":check": { "S": checkstr },
-        ":completed": { "S": "COMPLETED" }
-    }
-
-    print('Reading from ' + ddbtable)
-    try:
-        response = client['ddb']['handle'].scan(
-            TableName=ddbtable,
-            ExpressionAttributeValues=eav,
-            FilterExpression="replication_status <> :completed and start_datetime < :check",
-            Limit=1000
-            )
-    except Exception as e:
-        print(e)
-        print('Table ' + ddbtable + ' scan failed')
-        raise e
-
-    print('Checking for incomplete items from ' + ddbtable)
-    process_items(response['Items'])
-
-
-    while 'LastEvaluatedKey' in response:
-        response = client['ddb']['handle'].scan(
-            TableName=ddbtable,
-            FilterExpression="replication_status <> :completed and start_datetime < :check",
-            ExpressionAttributeValues=eav,
-            ExclusiveStartKey=response['LastEvaluatedKey'],
-            Limit=1000
-            )
-
-        process_items(response['Items'])
+
+    pages = queue.Queue(maxsize=page_queue_depth)
+    stop = threading.Event() # set if processing fails, to stop the producers
+
+    def query_status(status):
+        # Set query key condition attrs
+        eav = {
+            ":check": { "S": checkstr },
+            ":status": { "S": status }
+        }
+
+        print('Reading ' + status + ' items from ' + ddbtable + '/' + incomplete_index)
+        try:
+            response = client['ddb']['handle'].query(
+                TableName=ddbtable,
+                IndexName=incomplete_index,
+                ExpressionAttributeValues=eav,
+                KeyConditionExpression="incomplete_status = :status and start_datetime < :check",
+                ProjectionExpression=item_projection,
+                Limit=1000
+                )
+            pages.put(response['Items'])
+
+            while 'LastEvaluatedKey' in response and not stop.is_set():
+                response = client['ddb']['handle'].query(
+                    TableName=ddbtable,
+                    IndexName=incomplete_index,
+                    KeyConditionExpression="incomplete_status = :status and start_datetime < :check",
+                    ExpressionAttributeValues=eav,
+                    ExclusiveStartKey=response['LastEvaluatedKey'],
+                    ProjectionExpression=item_projection,
+                    Limit=1000
+                    )
+                pages.put(response['Items'])
+        except Exception as e:
+            print(e)
+            print('Table ' + ddbtable + ' query failed')
+            raise e
+        finally:
+            pages.put(None) # this partition is done
+
+    # -----------------------------------------------------------------
+    # full_scan - parallel scan for incomplete rows missing from the GSI.
+    # Each segment pages through its share of the table.
+    #
+    def scan_segment(segment):
+        eav = {
+            ":check": { "S": checkstr },
+            ":done": { "S": "COMPLETED" }
+        }
+        try:
+            response = client['ddb']['handle'].scan(
+                TableName=ddbtable,
+                ExpressionAttributeValues=eav,
+                FilterExpression="attribute_not_exists(incomplete_status) and start_datetime < :check and (attribute_not_exists(replication_status) or replication_status <> :done)",
+                Segment=segment,
+                TotalSegments=scan_segments,
+                ProjectionExpression=item_projection,
+                Limit=1000
+                )
+            pages.put(response['Items'])
+
+            while 'LastEvaluatedKey' in response and not stop.is_set():
+                response = client['ddb']['handle'].scan(
+                    TableName=ddbtable,
+                    FilterExpression="attribute_not_exists(incomplete_status) and start_datetime < :check and (attribute_not_exists(replication_status) or replication_status <> :done)",
+                    ExpressionAttributeValues=eav,
+                    ExclusiveStartKey=response['LastEvaluatedKey'],
+                    Segment=segment,
+                    TotalSegments=scan_segments,
+                    ProjectionExpression=item_projection,
+                    Limit=1000
+                    )
+                pages.put(response['Items'])
+        except Exception as e:
+            print(e)
+            print('Table ' + ddbtable + ' scan failed (segment ' + str(segment) + ')')
+            raise e
+        finally:
+            pages.put(None) # this segment is done
+
+    producers = [ (query_status, status) for status in incomplete_statuses ]
+    if full_scan == 'Yes':
+        print('Scanning ' + ddbtable + ' in ' + str(scan_segments) + ' segments')
+        producers += [ (scan_segment, seg) for seg in range(scan_segments) ]
+
+    with ThreadPoolExecutor(max_workers=len(producers)) as ex:
+        futures = [ ex.submit(*p) for p in producers ]
+        remaining = len(futures)
+        try:
+            while remaining > 0:
+                items = pages.get()
+                if items is None:
+                    remaining -= 1
+                    continue
+                print('Checking ' + str(len(items)) + ' incomplete items from ' + ddbtable)
+                process_items(items)
+                flush_statistics()
+                flush_purges()
+        except Exception as e:
+            # Drain the queue so blocked producers can see stop and exit
+            stop.set()
+            while remaining > 0:
+                if pages.get() is None:
+                    remaining -= 1
+            raise e
+        for f in futures:
+            f.result() # re-raise a failed query or scan segment
 
 ###### M A I N ######
 client = connect_clients(client)
+# Make one cheap DynamoDB call now so endpoint resolution and the TLS
+# handshake happen during INIT rather than on the first invocation
+try:
+    client['ddb']['handle'].describe_table(TableName=ddbtable)
+except Exception as e:
+    print(e)
+    print('Could not warm up the connection to ' + ddbtable)
+# Bound methods for the per-item calls, to skip the client dict lookups
+s3_head_object = client['s3']['handle'].head_object
+ddb_update_item = client['ddb']['handle'].update_item
@@ -17,24 +17,36 @@
 from __future__ import print_function
 
 import json
+import logging
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import os
-from datetime import datetime, timedelta
-import urllib.request
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import urllib3
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
 
 def getparm(parmname, defaultval):
-    try:
-        myval = os.environ[parmname]
-        print('Environmental variable \'' + parmname + '\' = ' + str(myval))
-        if isinstance(defaultval, int):
-            return int(myval)
-        else:
-            return myval
-    except:
-        print('Environmental variable \'' + parmname + '\' not found. Using default [' + \
-            str(defaultval) + ']')
+    myval = os.environ.get(parmname)
+    if myval is None:
+        log.info('Environmental variable \'%s\' not found. Using default [%s]', parmname, defaultval)
         return defaultval
+    log.info('Environmental variable \'%s\' = %s', parmname, myval)
+    if isinstance(defaultval, int):
+        try:
+            return int(myval)
+        except ValueError:
+            log.info('Environmental variable \'%s\' is not an integer. Using default [%s]', parmname, defaultval)
+            return defaultval
+    return myval
 
 # =====================================================================
 # Configuration
@@ -43,29 +55,28 @@ def getparm(parmname, defaultval):
 # recommended that you change this from the default 'CRRMonitor'
 appname = getparm('appname', 'CRRMonitor')
 
-# maxtask: Tune this parameter to get the most effective use of a single
-# instance of your lambda. It should be roughly 300,000 divided by the average
-# time required to process a single SQS record (160ms). Example: if it takes an
-# average of 500ms to process a single SQS record you would set this to
-# 300 / 0.5 = 600. This parameter tells the lambda when to ask for help:
-# If the queue depth is > maxtask it will spawn a copy of itself.
-maxtask = getparm('maxtask', 1800)
-
-# maxspawn: This parameter limits how many copies of itself the lambda
-# can spawn. This should not allow you to exceed your maximum concurrent
-# lambda execution limit (default 100). By default the lambda is set
-# to execute every minute and time out after 5. With a default maxspawn
-# of 25 this will allow 100 concurrent lambdas to execute. This should
-# allow capacity of 200 events per second at an average processing time
-# of 500ms per event, or 100 CRR replications per second. Scale and
-# request limits accordingly.
-maxspawn = getparm('maxspawn', 20)
-
 # How long to keep records for completed transfers
 purge_thresh = getparm('purge_thresh', 24)
 
-# DEBUG
+# message_workers: number of messages from an SQS batch that are handled
+# in parallel. The event source mapping delivers at most 10 per batch.
+message_workers = getparm('message_workers', 10)
+
+# metric_interval: the message count for the anonymous usage metric is
+# sent at most this often (seconds) per Lambda container, rather than
+# once per SQS batch.
+metric_interval = getparm('metric_interval', 60)
+
+# replication_regions: optional comma separated list of the regions of the
+# monitored buckets. An S3 client is created for each of them when the
+# container starts, instead of on the first message from that region.
+replication_regions = [r.strip() for r in getparm('replication_regions', '').split(',') if r.strip()]
+
+# DEBUG: 1 or more turns on debug logging; 2 also logs each event and 5
+# each DynamoDB record
 DEBUG = getparm('debug', 0)
+if DEBUG > 0:
+    log.setLevel(logging.DEBUG)
 
 # VERSION_ID: The version of this solution
 VERSION_ID = getparm('SolutionVersion', "").strip()
@@ -90,39 +101,114 @@ if ANONYMOUS_SOLUTION_ID is None or ANONYMOUS_SOLUTION_ID == "":
 # Do not change this without changing the template.
 ddbtable = appname
 stattable = ddbtable + 'Statistics'
-# queue: name of the SQS queue. Derived from the appname. The SQS queue
-# is created in the CloudFormation template. Do not change this without
-# changing the template
-queue = appname + 'Queue'
 # timefmt: used to format timestamps. Do not change.
 timefmt = '%Y-%m-%dT%H:%M:%SZ'
-# client: defines the api client connections to create
-client={
-    'ddb': {'service': 'dynamodb'},
-    'sqs': {'service': 'sqs'},
-    'lbd': {'service': 'lambda'}
-}
-s3client = {} # will hold client handle for s3 per region
+# client_config: botocore config shared by all clients. Keep-alive and a
+# larger connection pool avoid a new TLS handshake per call.
+client_config = Config(
+    max_pool_connections=64,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+)
+# tcp_keepalive needs botocore >= 1.27. Older versions reject the option;
+# they still reuse pooled HTTP/1.1 connections, just without TCP keep-alive.
+try:
+    client_config = client_config.merge(Config(tcp_keepalive=True))
+except TypeError:
+    log.info('botocore does not support tcp_keepalive - continuing without it')
+# Update expressions for the main table, one per kind of event. They do
+# not change, so they are built once here rather than per message.
+# incomplete_status is the IncompleteIdx hash key. It is only present
+# while the object is PENDING or FAILED, so that index stays sparse.
+#   replica: the replica side; it is always COMPLETED.
+#   source: COMPLETED source. if_not_exists keeps a status already
+#     written by another event.
+#   pending: PENDING source. As source, and copies the kept status to
+#     incomplete_status; if that is an earlier COMPLETED the completion
+#     (or clear_incomplete) removes it again.
+#   failed: FAILED source; the status is always recorded.
+#   completion: once both sides are in, by whichever event came second.
+replica_update_exp = 'set s3Object = :a, ObjectSize = :s, s3Replica = :d, end_datetime = :e, end_day = :y, itemttl = :p, replication_status = :b remove incomplete_status'
+source_update_exp = 'set s3Object = :a, ObjectSize = :s, s3Origin = :f, start_datetime = :g, replication_status = if_not_exists(replication_status, :b)'
+pending_update_exp = source_update_exp + ', incomplete_status = if_not_exists(replication_status, :b)'
+failed_update_exp = 'set s3Object = :a, ObjectSize = :s, s3Origin = :f, start_datetime = :g, replication_status = :b, incomplete_status = :b'
+completion_update_exp = 'set crr_rate = :r, elapsed = :t remove incomplete_status'
+completion_ttl_update_exp = 'set crr_rate = :r, elapsed = :t, itemttl = :p remove incomplete_status'
+clear_incomplete_exp = 'remove incomplete_status'
+completion_condition_exp = 'attribute_not_exists(crr_rate)'
 initfail = {} # hash of source buckets to handle FAILED counter initialization
+stats_lock = threading.Lock() # guards stats_acc and initfail
+# stats_acc: statistics increments not yet written to stattable, keyed by
+# statbucket. Filled by log_statistics, emptied by flush_statistics.
+stats_acc = defaultdict(lambda: {'objects': 0, 'size': 0, 'elapsed': 0})
+metric_ctr = 0 # messages processed since the last usage metric was sent
+metric_sent = time.time()
+# metric_http: kept for the life of the container so the usage metric
+# reuses its keep-alive connection instead of a new TLS handshake each time
+metric_http = urllib3.PoolManager(num_pools=1, maxsize=1)
+
+# =====================================================================
+# get_client
+# ----------
+# Return the client for a service (and optionally a region). Each client
+# is created on first use and cached for the life of the Lambda
+# container. Creation is serialized because the default boto3 session is
+# not thread safe, and messages are handled on several threads.
+# =====================================================================
+client_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def get_client(service, region=None):
+    with client_lock:
+        try:
+            return boto3.client(service, region_name=region, config=client_config)
+        except Exception as e:
+            log.error(e)
+            log.error('Error connecting to %s', service)
+            raise e
+
+# =====================================================================
+# parse_ts
+# --------
+# Parse a timefmt timestamp. fromisoformat is much faster than strptime;
+# the trailing 'Z' is dropped, so the result is a naive UTC datetime.
+# =====================================================================
+def parse_ts(tstamp):
+    return datetime.fromisoformat(tstamp[:-1])
+
+# epoch_str: the epoch seconds of a naive UTC datetime, as a DDB number
+# string. Unlike strftime('%s') this does not depend on the local timezone.
+def epoch_str(ts):
+    return str(int(ts.replace(tzinfo=timezone.utc).timestamp()))
 
 # =====================================================================
-# connect_clients
-# ---------------
-# Connect to all the clients. We will do this once per instantiation of
-# the Lambda function (not per execution)
+# flush_statistics
+# ----------------
+# Write the accumulated statistics, one update_item per statbucket. ADD
+# keeps this safe when concurrent event source mapping batches and
+# CRRHourlyMaint update the same statbucket. Each statbucket is dropped
+# once written, so a failure part way through keeps only the increments
+# that were not saved yet.
 # =====================================================================
-def connect_clients(clients_to_connect):
-    for c in clients_to_connect:
+def flush_statistics():
+    for statbucket, stat in list(stats_acc.items()):
         try:
-            if 'region' in clients_to_connect[c]:
-                clients_to_connect[c]['handle'] = boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'])
-            else:
-                clients_to_connect[c]['handle'] = boto3.client(clients_to_connect[c]['service'])
+            ddb_update_item(
+                TableName=stattable,
+                Key={'OriginReplicaBucket': {'S': statbucket}},
+                UpdateExpression='SET timebucket = :t, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d',
+                ExpressionAttributeValues={
+                    ':a': {'N': str(stat['objects'])},
+                    ':c': {'N': str(stat['size'])},
+                    ':d': {'N': str(stat['elapsed'])},
+                    ':t': {'S': stat['timebucket']},
+                    ':o': {'S': stat['source_bucket']},
+                    ':r': {'S': stat['dest_bucket']}
+                })
         except Exception as e:
-            print(e)
-            print('Error connecting to ' + clients_to_connect[c]['service'])
+            log.error(e)
+            log.error('Table %s update failed', stattable)
             raise e
-    return clients_to_connect
+        del stats_acc[statbucket]
 
 def message_handler(event):
     def log_statistics(Src, Dst, Tstamp, Size, ET, roundTo):
@@ -131,71 +217,145 @@ def message_handler(event):
         # (5 minute rolling window)
         #
         statbucket = Src + ':' + Dst
-        ts = datetime.strptime(Tstamp, timefmt)
-        secs = (ts.replace(tzinfo=None) - ts.min).seconds
-        rounding = (secs+roundTo/2) // roundTo * roundTo
-        ts = ts + timedelta(0, rounding-secs, -ts.microsecond)
-        timebucket = datetime.strftime(ts, timefmt)
+        epoch = int(parse_ts(Tstamp).replace(tzinfo=timezone.utc).timestamp())
+        rounded = (epoch + roundTo//2) // roundTo * roundTo
+        timebucket = datetime.utcfromtimestamp(rounded).strftime(timefmt)
         statbucket += ':' + timebucket
         # -------------------------------------------------------------
-        # Init a dict to use to hold our attrs for DDB
-        stat_exp_attrs = {}
-        # -------------------------------------------------------------
-        # Build the DDB UpdateExpression
-        stat_update_exp = 'SET timebucket = :t, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
-        # -------------------------------------------------------------
-        # push the first attr: s3Object
-        stat_exp_attrs[':a'] = {'N': '1'}
-        stat_exp_attrs[':c'] = {'N': Size}
-        stat_exp_attrs[':d'] = {'N': ET}
-        stat_exp_attrs[':t'] = {'S': timebucket}
-        stat_exp_attrs[':o'] = {'S': Src}
-        stat_exp_attrs[':r'] = {'S': Dst}
-        
-        # Update the DDB table
+        # Add to the running totals for this statbucket. Nothing is
+        # written here; flush_statistics writes them before the
+        # messages are deleted from the queue.
+        with stats_lock: # messages are handled on several threads
+            stat = stats_acc[statbucket]
+            stat['objects'] += 1
+            stat['size'] += int(Size)
+            stat['elapsed'] += int(ET)
+            stat['timebucket'] = timebucket
+            stat['source_bucket'] = Src
+            stat['dest_bucket'] = Dst
+
+            # Initialize a counter for failed replications for the source bucket
+            if not Src in initfail:
+                initfail[Src] = 'foo'
+            if Dst != 'FAILED' and initfail[Src] != timebucket:
+                log.info('Initializing FAILED bucket for %s:%s', Src, timebucket)
+                stat = stats_acc[Src + ':FAILED:' + timebucket]
+                stat['size'] += 1
+                stat['elapsed'] += 1
+                stat['timebucket'] = timebucket
+                stat['source_bucket'] = Src
+                stat['dest_bucket'] = 'FAILED'
+                initfail[Src] = timebucket
+
+    # -----------------------------------------------------------------
+    # record_completion - store the replication time once both the
+    # source and the replica event have been seen. The condition makes
+    # sure only one of them records it (and counts it in the statistics)
+    # when both are processed at the same time. Returns True if this
+    # call recorded it.
+    #
+    def record_completion(ETag, objsize, etimesecs, ttl):
+        crr_rate = int(objsize) * 8 / (etimesecs + 1) # Add 1 to prevent /0 errors
+        exp_attrs = {
+            ':r': {'N': str(crr_rate)},
+            ':t': {'N': str(etimesecs)}
+        }
+        if ttl is None:
+            update_exp = completion_update_exp
+        else:
+            update_exp = completion_ttl_update_exp
+            exp_attrs[':p'] = {'N': ttl}
         try:
-            response = client['ddb']['handle'].update_item(
-                TableName=stattable,
-                Key={'OriginReplicaBucket': {'S': statbucket}},
-                UpdateExpression=stat_update_exp,
-                ExpressionAttributeValues=stat_exp_attrs)
-        except Exception as e:
-            print(e)
-            print('Table ' + stattable + ' update failed')
+            ddb_update_item(
+                TableName=ddbtable,
+                Key={'ETag': ETag},
+                UpdateExpression=update_exp,
+                ConditionExpression=completion_condition_exp,
+                ExpressionAttributeValues=exp_attrs)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            log.error(e)
+            log.error('Table %s update failed', ddbtable)
             raise e
+        return True
 
-        # Initialize a counter for failed replications for the source bucket
-        if not Src in initfail:
-            initfail[Src] = 'foo'
-        if Dst != 'FAILED' and initfail[Src] != timebucket:
-            print('Initializing FAILED bucket for ' + Src + ':' + timebucket)
-            statbucket = Src + ':FAILED:' + timebucket
-            stat_exp_attrs = {}
-            # -------------------------------------------------------------
-            # Build the DDB UpdateExpression
-            stat_update_exp = 'SET timebucket = :t, source_bucket = :o, dest_bucket = :r ADD objects :a, size :c, elapsed :d'
-            # -------------------------------------------------------------
-            # push the first attr: s3Object
-            stat_exp_attrs[':a'] = {'N': '0'}
-            stat_exp_attrs[':c'] = {'N': '1'}
-            stat_exp_attrs[':d'] = {'N': '1'}
-            stat_exp_attrs[':t'] = {'S': timebucket}
-            stat_exp_attrs[':o'] = {'S': Src}
-            stat_exp_attrs[':r'] = {'S': 'FAILED'}
-
-            try:
-                response = client['ddb']['handle'].update_item(
-                    TableName=stattable,
-                    Key={'OriginReplicaBucket': {'S': statbucket }},
-                    UpdateExpression=stat_update_exp,
-                    ExpressionAttributeValues=stat_exp_attrs)
-                initfail[Src] = timebucket
-            except Exception as e:
-                print(e)
-                print('Table ' + stattable + ' update failed')
-                raise e
+    # -----------------------------------------------------------------
+    # clear_incomplete - take a COMPLETED row back out of IncompleteIdx
+    #
+    def clear_incomplete(ETag):
+        try:
+            ddb_update_item(
+                TableName=ddbtable,
+                Key={'ETag': ETag},
+                UpdateExpression=clear_incomplete_exp,
+                ConditionExpression='replication_status = :b',
+                ExpressionAttributeValues={':b': {'S': 'COMPLETED'}})
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return
+            log.error(e)
+            log.error('Table %s update failed', ddbtable)
+            raise e
+
+    # -----------------------------------------------------------------
+    # replication_event - handle one S3 replication event notification
+    #
+    # s3:Replication:OperationFailedReplication and
+    # s3:Replication:OperationCompletedReplication are sent for buckets
+    # with replication metrics enabled. To use them, publish them to an
+    # SNS topic in this account subscribed to the CRRMonitor queue. Rows
+    # that complete this way leave IncompleteIdx, so CRRHourlyMaint no
+    # longer polls them.
+    #
+    def replication_event(record):
+        if record['eventName'] == 'Replication:OperationFailedReplication':
+            status = 'FAILED'
+            update_exp = 'set s3Object = :a, s3Origin = :f, replication_status = :b, itemttl = if_not_exists(itemttl, :p), incomplete_status = :b'
+        elif record['eventName'] == 'Replication:OperationCompletedReplication':
+            status = 'COMPLETED'
+            update_exp = 'set s3Object = :a, s3Origin = :f, replication_status = :b, itemttl = if_not_exists(itemttl, :p) remove incomplete_status'
+        else:
+            log.debug('Ignoring %s event', record['eventName'])
+            return
+
+        bucket = record['s3']['bucket']['name']
+        obj = record['s3']['object']
+        # Same key as the head_object path: the etag, and the version id
+        # sliced the same way as the x-amz-version-id header (which may
+        # also be missing)
+        ETag = {'S': obj['eTag'] + ':' + obj.get('versionId', '')[1:-1]}
+        # eventTime has milliseconds; trim it to timefmt
+        now = record['eventTime'][:19] + 'Z'
+        # Set the ttl as the replica path does, so a row only this event
+        # creates still expires. if_not_exists keeps one already set.
+        purge = parse_ts(now) - timedelta(hours=purge_thresh) # datetime object
+
+        # Only write (and count a failure) if the status actually changes,
+        # so a redelivered event or the source PutObject event seeing the
+        # same FAILED status is not counted twice.
+        try:
+            ddb_update_item(
+                TableName=ddbtable,
+                Key={'ETag': ETag},
+                UpdateExpression=update_exp,
+                ConditionExpression='attribute_not_exists(replication_status) or replication_status <> :b',
+                ExpressionAttributeValues={
+                    # Notification keys are URL encoded, unlike CloudTrail's
+                    ':a': {'S': urllib.parse.unquote_plus(obj['key'])},
+                    ':f': {'S': bucket},
+                    ':b': {'S': status},
+                    ':p': {'N': epoch_str(purge)}
+                })
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return
+            log.error(e)
+            log.error('Table %s update failed', ddbtable)
+            raise e
 
-        #print('Stats written to ' + statbucket)
+        if status == 'FAILED':
+            log_statistics(bucket, 'FAILED', now, '0', '1', 300)
 
     # So this will work with CloudWatch Events directly or via SNS, let's look
     #   at the structure of the incoming JSON. Note that this has not been
@@ -214,17 +374,21 @@ def message_handler(event):
     elif 'Records' in event:
         # An SNS notification will have another layer in the dict. Look for
         #   EventSource = aws:sns. Otherwise generate an exception and get out.
-        if event['Records'][0]['EventSource'] == 'aws:sns':
+        if event['Records'][0].get('EventSource') == 'aws:sns':
             #print('Message is ' + event['Records'][0]['Sns']['Message'])
             evdata = json.loads(event['Records'][0]['Sns']['Message'])
             #print("Message event: " + json.dumps(evdata, indent=2))
 
+        elif event['Records'][0].get('eventSource') == 'aws:s3':
+            # S3 event notification delivered straight to the queue
+            evdata = event
+
         else:
             # Unrecognized event format: uncomment print statements to
             #    identify the format and enhance this logic. At the end of
             #    the day, evdata must contain the dict for the event record
             #    of the Cloudwatch log event for the S3 update notification
-            print('Error: unrecognized event format received')
+            log.error('Error: unrecognized event format received')
             raise Exception('Unrecognized event format')
 
     elif 'MessageId' in event:
@@ -233,14 +397,24 @@ def message_handler(event):
         evdata = event
 
     if DEBUG > 1:
-        print(json.dumps(evdata))
+        log.debug(json.dumps(evdata))
+
+    #-----------------------------------------------------------------
+    # S3 replication event notifications carry the final status of a
+    # source object, so record it here without a head_object
+    #
+    if 'Records' in evdata and evdata['Records'][0].get('eventSource') == 'aws:s3':
+        for record in evdata['Records']:
+            replication_event(record)
+        return
 
     #-----------------------------------------------------------------
     # Quietly ignore all but PutObject
     #
-    if evdata['detail']['eventName'] != 'PutObject':
-        if DEBUG > 0:
-            print('Ignoring ' + evdata['detail']['eventName'] + ' event')
+    detail = evdata.get('detail', {})
+    eventname = detail.get('eventName')
+    if eventname != 'PutObject':
+        log.debug('Ignoring %s event', eventname)
         return
 
     #-----------------------------------------------------------------
@@ -248,29 +422,21 @@ def message_handler(event):
     # Collect the data we want for the DynamoDB table
     #
     region = evdata['region']
-    bucket = evdata['detail']['requestParameters']['bucketName']
-    key = evdata['detail']['requestParameters']['key']
+    params = detail.get('requestParameters') or {}
+    bucket = params.get('bucketName')
+    key = params.get('key')
+    if bucket is None or key is None:
+        log.info('IGNORING: PutObject event without a bucket name and key')
+        return
 
     # This timestamp is from the CW Event record and is most accurate
-    now = evdata['detail']['eventTime']
-
-    # Init a dict to use to hold our attrs for DDB
-    ddb_exp_attrs = {}
-    # Build th e DDB UpdateExpression
-    ddb_update_exp = 'set s3Object = :a'
-    # push the first attr: s3Object
-    ddb_exp_attrs[':a'] = {'S': key}
-
-
-    # establish s3 client per region, but only once.
-    if not region in s3client:
-        s3client[region] = boto3.client('s3', region)
+    now = detail['eventTime']
 
     # -----------------------------------------------------------------
     # Do a head_object. If the object no longer exists just return.
     #
     try:
-        response = s3client[region].head_object(
+        response = get_client('s3', region).head_object(
             Bucket=bucket,
             Key=key
             )
@@ -296,26 +462,22 @@ def message_handler(event):
         #   }
 
         if e.response['Error']['Code'] == '403':
-            print('IGNORING: CRRMonitor does not have access to Object - ' + \
-                evdata['detail']['requestParameters']['bucketName'] + '/' + \
-                evdata['detail']['requestParameters']['key'])
+            log.info('IGNORING: CRRMonitor does not have access to Object - %s/%s', bucket, key)
         elif e.response['Error']['Code'] == '404':
-            print('IGNORING: Object no longer exists - ' + \
-                evdata['detail']['requestParameters']['bucketName'] + '/' + \
-                evdata['detail']['requestParameters']['key'])
+            log.info('IGNORING: Object no longer exists - %s/%s', bucket, key)
 
         else:
             # Need to improve this to recognize specifically a 404
-            print('Unhandled ClientError ' + str(e))
-            print(json.dumps(e.response))
+            log.error('Unhandled ClientError %s', e)
+            log.error(json.dumps(e.response))
 
         #print('Removing from queue / ignoring')
         return
 
     except Exception as e:
         # Need to improve this to recognize specifically a 404
-        print('Unandled Exception ' + str(e))
-        print('Removing from queue / ignoring')
+        log.error('Unandled Exception %s', e)
+        log.error('Removing from queue / ignoring')
         return
 
 
@@ -340,51 +502,18 @@ def message_handler(event):
     headers = response['ResponseMetadata']['HTTPHeaders']
 
     # If this object has no x-amz-replication-status header then we can leave
-    if 'x-amz-replication-status' not in headers:
+    repstatus = headers.get('x-amz-replication-status')
+    if repstatus is None:
         # This is not a replicated object - get out
-        if DEBUG > 0:
-            print('Not a replicated object')
+        log.debug('Not a replicated object')
         return()
 
-    # repstatus is a pointer to the headers (for code clarity)
-    repstatus = headers['x-amz-replication-status']
-
-    # -----------------------------------------------------------------
-    # Verify that the DynamoDB table exists. Note: we could create it
-    #  but that takes so long that the lambda function may time out.
-    #  Better to create it in the CFn template and handle this as a
-    #  failure condition
-    #
-    try:
-        response = client['ddb']['handle'].describe_table(
-            TableName=ddbtable
-        )
-    except Exception as e:
-        print(e)
-        print('Table ' + ddbtable + ' does not exist - need to create it')
-        raise e
-
-    # Update object size
     objsize = headers['content-length']
-    ddb_update_exp += ', ObjectSize = :s'
-    ddb_exp_attrs[':s'] = {'N': objsize}
-
-    ETag = {'S': headers['etag'][1:-1] + ':' + headers['x-amz-version-id'][1:-1]}
 
-    # -----------------------------------------------------------------
-    # If the object already has a DDB record get it
-    #
-    ddbdata = client['ddb']['handle'].get_item(
-        TableName=ddbtable,
-        Key={'ETag': ETag},
-        ConsistentRead=True
-        )
-
-    ddbitem = {} # reset the dict
-    if 'Item' in ddbdata:
-        ddbitem = ddbdata['Item']
-        if DEBUG > 4:
-            print("DDB record: " + json.dumps(ddbitem, indent=2))
+    # The key is the unquoted etag and the version id. The version id is
+    # not quoted, but existing rows (and replication_event) drop its first
+    # and last characters, so keep doing that or the keys would not match.
+    ETag = {'S': headers.get('etag', '').strip('"') + ':' + headers.get('x-amz-version-id', '')[1:-1]}
 
     #
     # Is this a REPLICA? Use timestamp as completion time
@@ -396,253 +525,174 @@ def message_handler(event):
     #
     if repstatus == 'REPLICA':
         # print('Processing a REPLICA object: ' + ETag['S'])
-        ddb_update_exp += ', s3Replica = :d'
-        ddb_exp_attrs[':d'] = {'S': bucket}
-        #print('s3Replica: ' + bucket)
-
-        ddb_update_exp += ', end_datetime = :e'
-        ddb_exp_attrs[':e'] = {'S': now} # 'now' is from the event data
-        #print('end_datetime: ' + now)
-
         # Set the ttl
-        purge = datetime.strptime(now, timefmt) - timedelta(hours=purge_thresh) # datetime object
-        ttl = purge.strftime('%s')
-        ddb_update_exp += ', itemttl = :p'
-        ddb_exp_attrs[':p'] = {'N': ttl}
-
-        # If this is a replica then status is COMPLETE
-        ddb_update_exp += ', replication_status = :b'
-        ddb_exp_attrs[':b'] = {'S': 'COMPLETED'}
-        #print('replication_status: COMPLETED (implied)')
-
-        if 'start_datetime' in ddbitem and 'crr_rate' not in ddbitem:
-            etime = datetime.strptime(now, timefmt) - datetime.strptime(ddbitem['start_datetime']['S'], timefmt)
-            etimesecs = (etime.days * 24 * 60 * 60) + etime.seconds
-            #print("Calculate elapsed time in seconds")
-            crr_rate = int(objsize) * 8 / (etimesecs + 1) # Add 1 to prevent /0 errors
-            ddb_update_exp += ', crr_rate = :r'
-            ddb_exp_attrs[':r'] = {'N': str(crr_rate)}
-            #print('crr_rate: ', crr_rate)
-
-            ddb_update_exp += ', elapsed = :t'
-            ddb_exp_attrs[':t'] = {'N': str(etimesecs)}
-            #print('elapsed: ', etimesecs)
-            log_statistics(
-                ddbitem['s3Origin']['S'],
-                bucket,
-                ddbitem['start_datetime']['S'],
-                objsize,
-                str(etimesecs),
-                300)
+        purge = parse_ts(now) - timedelta(hours=purge_thresh) # datetime object
+        ddb_update_exp = replica_update_exp
+        ddb_exp_attrs = {
+            ':a': {'S': key},
+            ':s': {'N': objsize},
+            ':d': {'S': bucket},
+            ':e': {'S': now}, # 'now' is from the event data
+            ':y': {'S': now[:10]}, # EndDateIdx partition
+            ':p': {'N': epoch_str(purge)},
+            ':b': {'S': 'COMPLETED'} # If this is a replica then status is COMPLETE
+        }
+
     # -----------------------------------------------------------------
     # Or is this a SOURCE? Use timestamp as replication start time
     #
-    else:
-
-        ddb_update_exp += ', s3Origin = :f'
-        ddb_exp_attrs[':f'] = {'S': bucket}
-
-        # If this is not a replica then do not report status. It's not important and
-        # makes the DynamoDB update much more complicated. Just get the start time
-        #
-        # We also do not care what the status is. If it has a FAILED status we could
-        # write code to send a notification, but that's outside our scope.
-        if repstatus == 'COMPLETED' or repstatus == 'FAILED' or repstatus == 'PENDING':
-            # print('Processing a ORIGINAL object: ' + ETag['S'] + ' status: ' + repstatus)
-            ddb_update_exp += ', start_datetime = :g'
-            ddb_exp_attrs[':g'] = {'S': now}
-            # ---------------------------------------------------------
-            # If we already got the replica event...
-            #
-            if 'end_datetime' in ddbitem and 'crr_rate' not in ddbitem:
-                etime = datetime.strptime(ddbitem['end_datetime']['S'], timefmt) - datetime.strptime(now, timefmt)
-                etimesecs = (etime.days * 24 * 60 * 60) + etime.seconds
-                #print("Calculate elapsed time in seconds")
-                crr_rate = int(objsize) * 8 / (etimesecs + 1) # Add 1 to prevent /0 errors
-                ddb_update_exp += ', crr_rate = :r'
-                ddb_exp_attrs[':r'] = {'N': str(crr_rate)}
-
-                # Set the ttl
-                purge = datetime.strptime(ddbitem['end_datetime']['S'], timefmt) - timedelta(hours=purge_thresh) # datetime object
-                ttl = purge.strftime('%s')
-                ddb_update_exp += ', itemttl = :p'
-                ddb_exp_attrs[':p'] = {'N': ttl}
-
-                ddb_update_exp += ', elapsed = :t'
-                ddb_exp_attrs[':t'] = {'N': str(etimesecs)}
-
-                log_statistics(
-                    bucket,ddbitem['s3Replica']['S'], 
-                    ddbitem['end_datetime']['S'], 
-                    objsize,
-                    str(etimesecs),300)
-            # ---------------------------------------------------------
-            # We did not yet get the replica event
-            #
-            else:
-                if repstatus == 'FAILED':
-                    # If replication failed this is the only time we will see this object.
-                    # Update the status to FAILED
-                    ddb_update_exp += ', replication_status = :b'
-                    ddb_exp_attrs[':b'] = {'S': 'FAILED'}
-                    log_statistics(
-                        bucket,
-                        'FAILED',
-                        now,
-                        '0',
-                        '1',
-                        300)
-
+    # If this is not a replica then only report status if nothing has been
+    # recorded yet (see source_update_exp). Otherwise just get the start time
+    #
+    # We also do not care what the status is. If it has a FAILED status we could
+    # write code to send a notification, but that's outside our scope.
+    elif repstatus == 'COMPLETED' or repstatus == 'FAILED' or repstatus == 'PENDING':
+        # print('Processing a ORIGINAL object: ' + ETag['S'] + ' status: ' + repstatus)
+        if repstatus == 'FAILED':
+            # If replication failed this is the only time we will see this object.
+            # Update the status to FAILED
+            ddb_update_exp = failed_update_exp
+        elif repstatus == 'PENDING':
+            ddb_update_exp = pending_update_exp
         else:
-            print('Unknown Replication Status: ' + repstatus)
-            raise Exception('Unknown Replication Status')
-
+            ddb_update_exp = source_update_exp
+        ddb_exp_attrs = {
+            ':a': {'S': key},
+            ':s': {'N': objsize},
+            ':f': {'S': bucket},
+            ':g': {'S': now},
+            ':b': {'S': repstatus}
+        }
 
+    else:
+        log.error('Unknown Replication Status: %s', repstatus)
+        raise Exception('Unknown Replication Status')
 
-# Create a record in the DDB table
+    # -----------------------------------------------------------------
+    # Create or update the record in the DDB table. ALL_OLD returns what
+    # was there before, so the other side's event (if it was already
+    # processed) is known without a separate get_item.
+    #
     try:
-        response = client['ddb']['handle'].update_item(
+        response = ddb_update_item(
             TableName=ddbtable,
             Key={'ETag': ETag},
             UpdateExpression=ddb_update_exp,
-            ExpressionAttributeValues=ddb_exp_attrs)
+            ExpressionAttributeValues=ddb_exp_attrs,
+            ReturnValues='ALL_OLD')
     except Exception as e:
-        print(e)
-        print('Table ' + ddbtable + ' update failed')
+        log.error(e)
+        log.error('Table %s update failed', ddbtable)
         raise e
 
+    ddbitem = response.get('Attributes', {})
+    if DEBUG > 4:
+        log.debug("DDB record: %s", json.dumps(ddbitem, indent=2))
+
+    # -----------------------------------------------------------------
+    # If both events have now been seen, record the replication time
+    #
+    start = ddbitem.get('start_datetime')
+    end = ddbitem.get('end_datetime')
+    if repstatus == 'REPLICA':
+        if start is not None and 'crr_rate' not in ddbitem:
+            etime = parse_ts(now) - parse_ts(start['S'])
+            etimesecs = (etime.days * 24 * 60 * 60) + etime.seconds
+            if record_completion(ETag, objsize, etimesecs, None):
+                log_statistics(
+                    ddbitem['s3Origin']['S'],
+                    bucket,
+                    start['S'],
+                    objsize,
+                    str(etimesecs),
+                    300)
+    elif end is not None and 'crr_rate' not in ddbitem:
+        # We already got the replica event
+        etime = parse_ts(end['S']) - parse_ts(now)
+        etimesecs = (etime.days * 24 * 60 * 60) + etime.seconds
+        # Set the ttl
+        purge = parse_ts(end['S']) - timedelta(hours=purge_thresh) # datetime object
+        if record_completion(ETag, objsize, etimesecs, epoch_str(purge)):
+            log_statistics(
+                bucket,ddbitem['s3Replica']['S'],
+                end['S'],
+                objsize,
+                str(etimesecs),300)
+    elif repstatus == 'PENDING' and ddbitem.get('replication_status', {}).get('S') == 'COMPLETED':
+        # Already complete (a redelivered event): pending_update_exp put
+        # the COMPLETED status into incomplete_status
+        clear_incomplete(ETag)
+    elif repstatus == 'FAILED':
+        # A replication event may already have counted it
+        if ddbitem.get('replication_status', {}).get('S') != 'FAILED':
+            log_statistics(
+                bucket,
+                'FAILED',
+                now,
+                '0',
+                '1',
+                300)
+
 # =====================================================================
 # queue_handler
 # -------------
 # Main entry point
-# Count the SQS queue and manage scale.
+# Invoked by the SQS event source mapping on the CRRMonitor queue with a
+# batch of up to 10 messages. The Lambda service polls the queue and
+# scales out the number of concurrent batches, up to the mapping's
+# MaximumConcurrency (20 in the template); messages are deleted when
+# this returns. If it raises, the whole batch becomes visible again after
+# the queue's visibility timeout and is retried (and sent to the dead
+# letter queue after 10 receives).
 # Here's what my event looks like:
 # {
-#   "account": "SAMPLE12345",
-#   "region": "us-east-2",
-#   "detail": {},
-#   "detail-type": "Scheduled Event",
-#   "source": "aws.events",
-#   "version": "0",
-#   "time": "2017-02-09T13:56:03Z",
-#   "id": "a8b4f046-06c5-4b3c-b543-90c3fdaaac14",
-#   "resources": [
-#       "arn:aws:events:us-east-2:SAMPLE12345:rule/CRRMonitor-2"
+#   "Records": [
+#       {
+#           "messageId": "059f36b4-87a3-44ab-83d2-661975830a7d",
+#           "receiptHandle": "AQEBwJnKyrHigUMZj6rYigCgxlaS3SLy0a...",
+#           "body": "{ SNS notification }",
+#           "attributes": {},
+#           "messageAttributes": {},
+#           "eventSource": "aws:sqs",
+#           "eventSourceARN": "arn:aws:sqs:us-east-2:SAMPLE12345:CRRMonitorQueue",
+#           "awsRegion": "us-east-2"
+#       }
 #   ]
 # }
-#
-# When I spawn a child process I will change "detail-type" to "Spawned Event"
-# and add "child-number", where 0 is the top-level
 # =====================================================================
 def queue_handler(event, context):
-    cnum = 0
-    if 'child-number' in event:
-        cnum = int(event['child-number'])
-
-    message_floor = cnum * maxtask
-
-    # {
-    #   "Attributes": {"ApproximateNumberOfMessages": "1040"},
-    #   "ResponseMetadata": {
-    #       "RetryAttempts": 0,
-    #       "HTTPStatusCode": 200,
-    #       "RequestId": "51c43b7e-9b05-59c8-b68e-6a68f3f3b999",
-    #       "HTTPHeaders": {
-    #           "x-amzn-requestid": "51c43b7e-9b05-59c8-b68e-6a68f3f3b999",
-    #           "content-length": "360",
-    #           "server": "Server",
-    #           "connection": "keep-alive",
-    #           "date": "Thu, 09 Feb 2017 12:55:18 GMT",
-    #           "content-type": "text/xml"
-    #       }
-    #   }
-    # }
-    response = client['sqs']['handle'].get_queue_attributes(
-        QueueUrl=queue_endpoint,
-        AttributeNames=['ApproximateNumberOfMessages']
-        )
-
-    if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-        print('Bad status from ' + queue + ': ' + response['ResponseMetadata']['HTTPStatusCode'])
-        return
-
-    queue_sz = int(response['Attributes']['ApproximateNumberOfMessages'])
-    queue_backlog = queue_sz - message_floor
-
-    print('INFO [CNUM-' + str(cnum) + '] Queue is ' + str(queue_sz) + \
-        ' deep. Backlog is ' + str(queue_backlog))
-
-    # We subtracted the number of messages for which processes are already
-    # running. If the backlog is still too deep them first spawn another child,
-    # updating child-number + 1
-    if queue_backlog > maxtask:
-        # increment child-number (or initialize to 1) in the event dict
-        # spawn another lambda, passing the event and context dicts
-        if cnum < maxspawn:
-            event['child-number'] = cnum + 1
-            try:
-                client['lbd']['handle'].invoke(
-                    FunctionName=context.function_name,
-                    InvocationType='Event',
-                    Payload=json.dumps(event)
-                )
-                print('Spawning a child because there are ' + str(queue_sz) + ' messages in the queue. I am child ' + str(cnum) + ' with a max capacity of ' + str(maxtask) + '. Message floor is ' + str(message_floor))
-
-                print('Reproduction successful - child ' + str(cnum+1) + ' spawned')
-            except Exception as e:
-                print(e)
-                print('ERROR[CNUM-' + str(cnum) + '] Failed to reproduce')
-                raise e
-        else:
-            print('WARNING: maxspawn(' + str(maxspawn) + ') exceeded. Not spawning a helper.')
-
-    # -----------------------------------------------------------------
-    # Now we get to work. Process messages from the queue until empty
-    # or we time out. This is the secret sauce to our horizontal scale
-    print('INFO [CNUM-' + str(cnum) + '] Priming read from SQS...')
-    msg_ctr = 0 # keep a count of messages processed
-    sqs_msgs = client['sqs']['handle'].receive_message(
-        QueueUrl=queue_endpoint,
-        AttributeNames=['All'],
-        MaxNumberOfMessages=10,
-        VisibilityTimeout=60
-    )
-    sqs_delete = []
-    while 'Messages' in sqs_msgs:
-        print('INFO [CNUM-' + str(cnum) + '] Processing ' + str(len(sqs_msgs['Messages'])) + ' messages')
-        for message in sqs_msgs['Messages']:
-            rc = message_handler(json.loads(message['Body']))
-            # If we did not get a 0 return code let the record time out back
-            # back into the queue
-            if not rc:
-                sqs_delete.append({'Id': message['MessageId'], 'ReceiptHandle':  message['ReceiptHandle']})
-                msg_ctr += 1 # keep a count of messages processed
-
-        if len(sqs_delete) > 0:
-            # Delete the messages we just processed
-            response = client['sqs']['handle'].delete_message_batch(
-                QueueUrl=queue_endpoint,
-                Entries=sqs_delete
-            )
-            if len(response['Successful']) < len(sqs_delete):
-                print('ERROR[CNUM-' + str(cnum) + ']: processed ' + str(len(sqs_msgs)) + ' messages but only deleted ' + str(len(response['Successful'])) + ' messages')
+    global metric_ctr, metric_sent
 
-        sqs_delete = [] # reset the list
+    records = event.get('Records', [])
+    log.info('Processing %d messages', len(records))
 
-        print('INFO [CNUM-' + str(cnum) + '] Reading from SQS...')
-        sqs_msgs = client['sqs']['handle'].receive_message(
-            QueueUrl=queue_endpoint,
-            AttributeNames=['All'],
-            MaxNumberOfMessages=10,
-            VisibilityTimeout=60
-        )
+    # The messages in a batch are independent and their handling is all
+    # DynamoDB/S3 calls, so run them on a thread pool
+    try:
+        with ThreadPoolExecutor(max_workers=message_workers) as executor:
+            # list() so the first failed message is re-raised here
+            list(executor.map(lambda r: message_handler(json.loads(r['body'])), records))
+    except Exception as e:
+        # Logged here so the cause is seen even if the flush below fails
+        # too and its error is the one raised
+        log.error('Batch failed: %s', e)
+        raise e
+    finally:
+        # Save the statistics before the messages are deleted, and also when
+        # the batch fails: the whole batch is then redelivered, but the
+        # messages already written find their completion recorded and do
+        # not count again, so their increments would otherwise be lost.
+        flush_statistics()
 
-    print('INFO [CNUM-' + str(cnum) + '] Completed - ' + str(msg_ctr) + ' messages processed')
+    log.info('Completed - %d messages processed', len(records))
 
-    if SEND_ANONYMOUS_USAGE_METRIC and msg_ctr > 0:
+    metric_ctr += len(records)
+    if SEND_ANONYMOUS_USAGE_METRIC and metric_ctr > 0 and time.time() - metric_sent >= metric_interval:
         send_anonymous_usage_metric({
-            "Action": f"Num messages processed by CRRMonitor: {msg_ctr}"
+            "Action": f"Num messages processed by CRRMonitor: {metric_ctr}"
         })
+        metric_ctr = 0
+        metric_sent = time.time()
 
 def send_anonymous_usage_metric(metric_data={}):
     try:
@@ -660,22 +710,30 @@ def send_anonymous_usage_metric(metric_data={}):
         data = bytes(json.dumps(metric_payload), 'utf-8')
         headers = { "Content-Type": "application/json" }
 
-        print(f"Sending anonymous usage metric: {str(metric_payload)}")
+        log.info('Sending anonymous usage metric: %s', metric_payload)
 
-        req = urllib.request.Request(url=metric_endpoint, data=data, method='POST', headers=headers)
-        with urllib.request.urlopen(req) as f:
-            print(f"Anonymous usage metric send status: {f.status}")
+        # Sent before returning: a background thread would be frozen with
+        # the container once the handler returns. The short timeout and no
+        # retries bound the wait.
+        response = metric_http.request('POST', metric_endpoint, body=data, headers=headers, timeout=2.0, retries=False)
+        log.info('Anonymous usage metric send status: %s', response.status)
     except Exception as e:
         # Log the exception but do not raise it again
-        print(f'Exception while sending anonymous usage metric: {e}')
+        log.warning('Exception while sending anonymous usage metric: %s', e)
 
 ###### M A I N ######
-client = connect_clients(client)
+ddb_client = get_client('dynamodb')
+ddb_update_item = ddb_client.update_item # bound once; called for every message
+for region in replication_regions:
+    get_client('s3', region)
+# Verify that the DynamoDB table exists, once per container. Note: we
+#  could create it but that takes so long that the lambda function may
+#  time out. Better to create it in the CFn template and handle this as
+#  a failure condition. This also warms the DynamoDB connection during
+#  INIT rather than on the first invocation.
 try:
-    queue_endpoint = client['sqs']['handle'].get_queue_url(
-        QueueName=queue
-    )['QueueUrl']
+    ddb_client.describe_table(TableName=ddbtable)
 except Exception as e:
-    print(e)
-    print('Could not get the url for ' + queue)
+    log.error(e)
+    log.error('Table %s does not exist - need to create it', ddbtable)
     raise e
@@ -18,9 +18,13 @@ from __future__ import print_function
 
 import json
 import boto3
+from botocore.config import Config
 import os
+import random
+import time
 import logging
 from datetime import datetime,timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -28,15 +32,17 @@ log.setLevel(logging.INFO)
 log.debug('Loading function')
 
 def getparm (parmname, defaultval):
-    try:
-        myval = os.environ[parmname]
-        if isinstance(defaultval, int):
-            return int(myval)
-        else:
-            return myval
-    except:
+    myval = os.environ.get(parmname)
+    if myval is None:
         print('Environmental variable \'' + parmname + '\' not found. Using default [' + str(defaultval) + ']')
         return defaultval
+    if isinstance(defaultval, int):
+        try:
+            return int(myval)
+        except ValueError:
+            print('Environmental variable \'' + parmname + '\' is not an integer. Using default [' + str(defaultval) + ']')
+            return defaultval
+    return myval
 #
 # Define the DynamoDB table to be used to track replication status.
 #   It must be in the same region as this Lambda and should already
@@ -52,6 +58,32 @@ stack_name = getparm('stack_name','Nil')
 timefmt = '%Y-%m-%dT%H:%M:%SZ'
 roundTo = getparm('roundto', 300) # 5 minute buckets for CW metrics
 purge_thresh = getparm('purge_thresh', 24) # threshold in hours
+metric_batch = 1000 # max MetricData entries per PutMetricData request
+# Only the attributes build_metric_data and purge_stats use are read back
+# from the statistics table. size is a reserved word, hence #size.
+stats_projection = 'timebucket, source_bucket, dest_bucket, objects, #size, elapsed'
+purge_batch = 25 # max DeleteRequests per BatchWriteItem request
+purge_retries = getparm('purge_retries', 5)
+firehose_batch = 500 # max records per PutRecordBatch request
+firehose_bytes = 4000000 # stay under the 4 MiB PutRecordBatch limit
+firehose_retries = getparm('firehose_retries', 5)
+# archive_index: EndDateIdx once it is seen ACTIVE. The template only
+# creates it when archiving to S3, and it is still being built (or not
+# there yet) after a stack update, so until then the archive scans.
+archive_index = { 'name': 'EndDateIdx', 'active': False }
+# client_config: botocore config shared by all clients. The connection
+# pool is large enough for the threads that share a client, and retries
+# absorb CloudWatch and DynamoDB throttling.
+client_config = Config(
+    max_pool_connections=64,
+    retries={'max_attempts': 10, 'mode': 'standard'}
+)
+# tcp_keepalive needs botocore >= 1.27. Older versions reject the option;
+# they still reuse pooled HTTP/1.1 connections, just without TCP keep-alive.
+try:
+    client_config = client_config.merge(Config(tcp_keepalive=True))
+except TypeError:
+    print('botocore does not support tcp_keepalive - continuing without it')
 client={
     'cw': { 'service': 'cloudwatch' },
     'ddb': { 'service': 'dynamodb'}
@@ -71,9 +103,9 @@ def connect_clients(clients_to_connect):
     for c in clients_to_connect:
         try:
             if 'region' in clients_to_connect[c]:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'])
+                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'], config=client_config)
             else:
-                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'])
+                clients_to_connect[c]['handle']=boto3.client(clients_to_connect[c]['service'], config=client_config)
         except Exception as e:
             print(e)
             print('Error connecting to ' + clients_to_connect[c]['service'])
@@ -82,174 +114,261 @@ def connect_clients(clients_to_connect):
 
 def lambda_handler(event, context):
     # -----------------------------------------------------------------
-    # save items in S3 - save items
+    # save items in S3 - buffer items and write them to firehose with
+    # put_record_batch, firehose_batch records or firehose_bytes a call
     #
-    def save_item(item):
-        print('Save Item' + json.dumps(item))
+    def flush_batch(buf):
+        records = [ { 'Data': r } for r in buf ]
         try:
-            response = client['firehose']['handle'].put_record(
-                DeliveryStreamName=kinesisfirestream,
-                Record={
-                    'Data': json.dumps(item) + '\n'
-                }
-            )
+            for attempt in range(firehose_retries + 1):
+                response = client['firehose']['handle'].put_record_batch(
+                    DeliveryStreamName=kinesisfirestream,
+                    Records=records
+                )
+                if response['FailedPutCount'] == 0:
+                    return
+                # Throttled - back off and resend only the failed records
+                records = [ records[n] for n, r in enumerate(response['RequestResponses']) if 'ErrorCode' in r ]
+                time.sleep(random.uniform(0, min(0.05 * (2 ** attempt), 2)))
+            raise Exception(str(len(records)) + ' records still unprocessed')
         except Exception as e:
             print(e)
-            print('Error saving ' + item['ETag']['S'] + ' from ' + ddbtable)
+            print('Error saving ' + str(len(buf)) + ' items from ' + ddbtable)
             raise e
 
-            # -----------------------------------------------------------------
+    def save_item(item):
+        data = json.dumps(item)
+        print('Save Item' + data)
+        data += '\n'
+        size = len(data.encode())
+        if fh_buf['records'] and (len(fh_buf['records']) >= firehose_batch or fh_buf['bytes'] + size > firehose_bytes):
+            flush_items()
+        fh_buf['records'].append(data)
+        fh_buf['bytes'] += size
+
+    def flush_items():
+        if fh_buf['records']:
+            flush_batch(fh_buf['records'])
+        fh_buf['records'] = []
+        fh_buf['bytes'] = 0
 
     # -----------------------------------------------------------------
-    # post_stats - post statistics to CloudWatch
+    # build_metric_data - CloudWatch datums for one statistics item
     #
-    def post_stats(item):
-        print('Posting statistics to CloudWatch for ' + item['source_bucket']['S'] + ' time bucket ' + item['timebucket']['S'])
-
+    def build_metric_data(item):
         ts=item['timebucket']['S']
+        src=item['source_bucket']['S']
+        dest=item['dest_bucket']['S']
+        objects=int(item['objects']['N'])
 
         # -------------------------------------------------------------
         # Special Handling: Failed replicatons are reported in the
         # same data format. The destination bucket will be FAILED.
         # Pull these out separately to a different CW metric.
-        if item['dest_bucket']['S'] == 'FAILED':
-            try:
-                client['cw']['handle'].put_metric_data(
-                    Namespace='CRRMonitor',
-                    MetricData=[
-                        {
-                            'MetricName': 'FailedReplications',
-                            'Dimensions': [
-                                {
-                                    'Name': 'SourceBucket',
-                                    'Value': item['source_bucket']['S']
-                                }
-                            ],
-                            'Timestamp': ts,
-                            'Value': int(item['objects']['N'])
-                        },
-                    ]
-                )
-            except Exception as e:
-                print(e)
-                print('Error creating CloudWatch metric FailedReplications')
-                raise e
+        if dest == 'FAILED':
+            return [
+                {
+                    'MetricName': 'FailedReplications',
+                    'Dimensions': [ { 'Name': 'SourceBucket', 'Value': src } ],
+                    'Timestamp': ts,
+                    'Value': objects
+                }
+            ]
+
+        # Both datums share one Dimensions list
+        dimensions = [
+            { 'Name': 'SourceBucket', 'Value': src },
+            { 'Name': 'DestBucket', 'Value': dest }
+        ]
+        speed = ((int(item['size']['N'])*8)/1024)/(int(item['elapsed']['N'])+1)
+        return [
+            {
+                'MetricName': 'ReplicationObjects',
+                'Dimensions': dimensions,
+                'Timestamp': ts,
+                'Value': objects
+            },
+            {
+                'MetricName': 'ReplicationSpeed',
+                'Dimensions': dimensions,
+                'Timestamp': ts,
+                'Value': speed
+            }
+        ]
+
+    # -----------------------------------------------------------------
+    # put_metric_data - publish up to metric_batch datums in one request
+    #
+    def put_metric_data(metric_data):
+        try:
+            client['cw']['handle'].put_metric_data(
+                Namespace='CRRMonitor',
+                MetricData=metric_data
+            )
+        except Exception as e:
+            print(e)
+            print('Error creating CloudWatch metric')
+            raise e
+
+    # -----------------------------------------------------------------
+    # purge_stats - remove statistics items once they have been posted,
+    # purge_batch deletes per BatchWriteItem request
+    #
+    def delete_stats(batch):
+        request_items = {
+            stattable: [
+                {
+                    'DeleteRequest': {
+                        'Key': {
+                            'OriginReplicaBucket': {
+                                'S': item['source_bucket']['S'] + ':' + item['dest_bucket']['S'] + ':' + item['timebucket']['S']
+                            }
+                        }
+                    }
+                } for item in batch
+            ]
+        }
+        try:
+            for attempt in range(purge_retries + 1):
+                response = client['ddb']['handle'].batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+                if not request_items:
+                    return
+                # Throttled - back off and retry only the unprocessed deletes
+                time.sleep(random.uniform(0, min(0.05 * (2 ** attempt), 2)))
+            raise Exception(str(len(request_items[stattable])) + ' deletes still unprocessed')
+        except Exception as e:
+            print(e)
+            print('Error purging from ' + batch[0]['timebucket']['S'])
+            raise e
+
+    def purge_stats(items):
+        for n in range(0, len(items), purge_batch):
+            batch = items[n:n + purge_batch]
+            delete_stats(batch)
+            for item in batch:
+                print('Purged statistics date for ' + item['timebucket']['S'])
+
+    # -----------------------------------------------------------------
+    # post_stats - queue a page of statistics for CloudWatch. Datums are
+    # accumulated across scan pages and published metric_batch at a time.
+    # An item's datums are never split across two requests.
+    #
+    def post_stats(items):
+        for item in items:
+            print('Posting statistics to CloudWatch for ' + item['source_bucket']['S'] + ' time bucket ' + item['timebucket']['S'])
+            metric_data = build_metric_data(item)
+            if len(pending['metrics']) + len(metric_data) > metric_batch:
+                flush_stats()
+            pending['metrics'] += metric_data
+            pending['items'].append(item)
+
+    # -----------------------------------------------------------------
+    # flush_stats - publish the queued datums (one request), then purge
+    # their items. Items are only deleted once their metrics are
+    # published, and each request's items are deleted before the next
+    # request, so a later failure cannot leave posted items to be posted
+    # again on the next run.
+    #
+    def flush_stats():
+        if pending['metrics']:
+            put_metric_data(pending['metrics'])
+
+        for item in pending['items']:
+            print ('Statistics posted to ' + item['timebucket']['S'])
+        purge_stats(pending['items'])
+
+        pending['metrics'] = []
+        pending['items'] = []
+
+    #======================== post_stats ==============================
 
-        else:
+    # -----------------------------------------------------------------
+    # archive_index_active - whether EndDateIdx can be queried yet
+    #
+    def archive_index_active():
+        if not archive_index['active']:
             try:
-                client['cw']['handle'].put_metric_data(
-                    Namespace='CRRMonitor',
-                    MetricData=[
-                        {
-                            'MetricName': 'ReplicationObjects',
-                            'Dimensions': [
-                                {
-                                    'Name': 'SourceBucket',
-                                    'Value': item['source_bucket']['S']
-                                },
-                                {
-                                    'Name': 'DestBucket',
-                                    'Value': item['dest_bucket']['S']
-                                }
-                            ],
-                            'Timestamp': ts,
-                            'Value': int(item['objects']['N'])
-                        },
-                    ]
+                response = client['ddb']['handle'].describe_table(
+                    TableName = ddbtable
                 )
             except Exception as e:
                 print(e)
-                print('Error creating CloudWatch metric')
+                print('Table ' + ddbtable + ' describe failed')
                 raise e
+            for idx in response['Table'].get('GlobalSecondaryIndexes', []):
+                if idx['IndexName'] == archive_index['name'] and idx['IndexStatus'] == 'ACTIVE':
+                    archive_index['active'] = True
+        return archive_index['active']
 
+    # -----------------------------------------------------------------
+    # read_archive - page through a query or scan, saving every item
+    #
+    def read_archive(op, request):
+        while True:
             try:
-                client['cw']['handle'].put_metric_data(
-                    Namespace='CRRMonitor',
-                    MetricData=[
-                        {
-                            'MetricName': 'ReplicationSpeed',
-                            'Dimensions': [
-                                {
-                                    'Name': 'SourceBucket',
-                                    'Value': item['source_bucket']['S']
-                                },
-                                {
-                                    'Name': 'DestBucket',
-                                    'Value': item['dest_bucket']['S']
-                                }
-                            ],
-                            'Timestamp': ts,
-                            'Value': ((int(item['size']['N'])*8)/1024)/(int(item['elapsed']['N'])+1)
-                        },
-                    ]
-                )
+                response = getattr(client['ddb']['handle'], op)(**request)
             except Exception as e:
                 print(e)
-                print('Error creating CloudWatch metric')
+                print('Table ' + ddbtable + ' ' + op + ' failed')
                 raise e
 
-        print ('Statistics posted to ' + ts)
-
-        try:
-            client['ddb']['handle'].delete_item(
-                TableName=stattable,
-                Key={
-                    'OriginReplicaBucket': {
-                        'S': item['source_bucket']['S'] + ':' + item['dest_bucket']['S'] + ':' + ts
-                    }
-                }
-            )
-            print('Purged statistics date for ' + ts)
-        except Exception as e:
-            print(e)
-            print('Error purging from ' + ts)
-            raise e
+            for i in response['Items']:
+                save_item(i)
 
-    #======================== post_stats ==============================
+            if 'LastEvaluatedKey' not in response:
+                break
+            request['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
     #==================================================================
     # firehose: retrieve all records completed in the last 5 minutes
     # Stream them to firehose
+    #
+    # Items are read through EndDateIdx (end_day, end_datetime) rather
+    # than a scan of the whole table. A window that crosses midnight is
+    # read one day partition at a time. Each day is a single partition
+    # of the index, so all of its completions land on one key; with the
+    # ALL projection the completion update (crr_rate, elapsed) rewrites
+    # the index entry as well.
     def firehose(ts):
         begts=ts - timedelta(minutes=5)
         arch_beg = begts.strftime(timefmt)
         arch_end = ts.strftime(timefmt)
-        # Set scan filter attrs
-        eav = {
-                ":archbeg": { "S": arch_beg },
-                ":archend": { "S": arch_end }
-            }
-
-        print('Reading from ' + ddbtable)
-        try:
-            response = client['ddb']['handle'].scan(
-                TableName=ddbtable,
-                ExpressionAttributeValues=eav,
-                FilterExpression="end_datetime >= :archbeg and end_datetime < :archend",
-                Limit=1000
-                )
-        except Exception as e:
-            print(e)
-            print('Table ' + ddbtable + ' scan failed')
-            raise e
+        # end_datetime < arch_end, as an inclusive key range
+        arch_last = (ts - timedelta(seconds=1)).strftime(timefmt)
 
         print('Archiving items from ' + ddbtable + ' beg>=' + arch_beg + ' end=' + arch_end)
 
-        for i in response['Items']:
-            save_item(i)
-
-        while 'LastEvaluatedKey' in response:
-            response = client['ddb']['handle'].scan(
-                TableName=ddbtable,
-                FilterExpression="end_datetime >= :archbeg and end_datetime < :archend",
-                ExpressionAttributeValues=eav,
-                ExclusiveStartKey=response['LastEvaluatedKey'],
-                Limit=1000
-                )
-
-            for i in response['Items']:
-                print('Items LastEvaluated ' + i['ETag']['S'])
-                save_item(i)
+        if not archive_index_active():
+            print('Index ' + archive_index['name'] + ' is not active - scanning ' + ddbtable)
+            read_archive('scan', {
+                'TableName': ddbtable,
+                'FilterExpression': "end_datetime >= :archbeg and end_datetime < :archend",
+                'ExpressionAttributeValues': {
+                    ":archbeg": { "S": arch_beg },
+                    ":archend": { "S": arch_end }
+                },
+                'Limit': 1000
+            })
+            flush_items()
+            return
+
+        for day in sorted({ arch_beg[:10], arch_last[:10] }):
+            eav = {
+                    ":archday": { "S": day },
+                    ":archbeg": { "S": arch_beg },
+                    ":archend": { "S": arch_last }
+                }
+            print('Reading from ' + ddbtable + ' for ' + day)
+            read_archive('query', {
+                'TableName': ddbtable,
+                'IndexName': archive_index['name'],
+                'KeyConditionExpression': "end_day = :archday and end_datetime between :archbeg and :archend",
+                'ExpressionAttributeValues': eav,
+                'Limit': 1000
+            })
+
+        flush_items()
     #====================== firehose ==================================
 
     # What time is it?
@@ -283,45 +402,64 @@ def lambda_handler(event, context):
     eav = {
             ":stats": { "S": statbucket }
         }
+    pending = { 'metrics': [], 'items': [] }
+    fh_buf = { 'records': [], 'bytes': 0 }
 
-    try:
-        response = client['ddb']['handle'].scan(
-            TableName=stattable,
-            ExpressionAttributeValues=eav,
-            FilterExpression="timebucket <= :stats",
-            ConsistentRead=True
-            )
-    except Exception as e:
-        print(e)
-        print('Table ' + ddbtable + ' scan failed')
-        raise e
-
-    if len(response['Items']) == 0:
-        print('WARNING: No stats bucket found for ' + statbucket)
-
-    for i in response['Items']:
-        post_stats(i)
-
-    while 'LastEvaluatedKey' in response:
+    # -----------------------------------------------------------------
+    # scan_stats - read one page of statistics, starting at start_key
+    #
+    def scan_stats(start_key):
+        scan = {
+            'TableName': stattable,
+            'FilterExpression': "timebucket <= :stats",
+            'ProjectionExpression': stats_projection,
+            'ExpressionAttributeNames': { '#size': 'size' },
+            'ExpressionAttributeValues': eav,
+            'ConsistentRead': True
+        }
+        if start_key is not None:
+            scan['ExclusiveStartKey'] = start_key
         try:
-            response = client['ddb']['handle'].scan(
-                TableName=ddbtable,
-                FilterExpression="timebucket <= :stats",
-                ExpressionAttributeValues=eav,
-                ExclusiveStartKey=response['LastEvaluatedKey'],
-                ConsistentRead=True
-                )
+            return client['ddb']['handle'].scan(**scan)
         except Exception as e:
             print(e)
-            print('Table ' + ddbtable + ' scan failed')
+            print('Table ' + stattable + ' scan failed')
             raise e
 
-        for i in response['Items']:
-            post_stats(i)
-
-    # Archive to firehose
-    if stream_to_kinesis == 'Yes':
-        firehose(ts)
+    # -----------------------------------------------------------------
+    # statistics - post every statistics page, then flush the remainder.
+    # The next page is read while the current one is being posted, so
+    # the scan overlaps the CloudWatch and DynamoDB writes.
+    #
+    def statistics():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            response = scan_stats(None)
+
+            if len(response['Items']) == 0:
+                print('WARNING: No stats bucket found for ' + statbucket)
+
+            while True:
+                next_page = None
+                if 'LastEvaluatedKey' in response:
+                    next_page = executor.submit(scan_stats, response['LastEvaluatedKey'])
+
+                post_stats(response['Items'])
+
+                if next_page is None:
+                    break
+                response = next_page.result()
+
+        flush_stats()
+
+    # Post statistics and archive to firehose at the same time. The two
+    # read different tables and write to different services. result()
+    # re-raises a failure from either one.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        phases = [ executor.submit(statistics) ]
+        if stream_to_kinesis == 'Yes':
+            phases.append(executor.submit(firehose, ts))
+        for phase in phases:
+            phase.result()
 
 ######## M A I N ########
 client = connect_clients(client)
@@ -17,7 +17,10 @@
 from __future__ import print_function
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 # Unable to import module? You need to zip CRRdeployagent.py with
 # cfn_resource.py!!
@@ -25,7 +28,25 @@ import cfn_resource
 
 handler = cfn_resource.Resource()
 
-source_buckets = []
+# get_bucket_replication calls are made bucket_workers at a time
+bucket_workers = 32
+alarm_workers = 16 # concurrent put_metric_alarm calls
+metric_batch = 1000 # max MetricData entries per PutMetricData request
+alarm_batch = 100 # max AlarmNames per DeleteAlarms request
+
+# client_config: botocore config shared by all clients. The connection
+# pool is larger than bucket_workers so the threads do not queue on it,
+# and retries absorb S3 and CloudWatch throttling.
+client_config = Config(
+    max_pool_connections=64,
+    retries={'max_attempts': 10, 'mode': 'standard'}
+)
+# tcp_keepalive needs botocore >= 1.27. Older versions reject the option;
+# they still reuse pooled HTTP/1.1 connections, just without TCP keep-alive.
+try:
+    client_config = client_config.merge(Config(tcp_keepalive=True))
+except TypeError:
+    print('botocore does not support tcp_keepalive - continuing without it')
 
 client = {
     's3': { 'service': 's3' },
@@ -45,9 +66,9 @@ def connect_clients(clients_to_connect):
     for c in clients_to_connect:
         try:
             if 'region' in clients_to_connect[c]:
-                clients_to_connect[c]['handle'] = boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'])
+                clients_to_connect[c]['handle'] = boto3.client(clients_to_connect[c]['service'], region_name=clients_to_connect[c]['region'], config=client_config)
             else:
-                clients_to_connect[c]['handle'] = boto3.client(clients_to_connect[c]['service'])
+                clients_to_connect[c]['handle'] = boto3.client(clients_to_connect[c]['service'], config=client_config)
         except Exception as e:
             print(e)
             print('Error connecting to ' + clients_to_connect[c]['service'])
@@ -75,33 +96,36 @@ def create_trail(trail_name, trail_log_bucket):
         raise e
 
 
-def get_buckets():
+# List the buckets that have replication enabled, with their replication
+# configuration. get_buckets and get_source_buckets share this one pass.
+def get_replicated_buckets():
     print('List Buckets:')
+    list_buckets = client['s3']['handle'].list_buckets()['Buckets']
+    replicated = []
+    for i, bucket_response in zip(list_buckets, get_bucket_replications(list_buckets)):
+        if bucket_response is not None \
+                and bucket_response['ReplicationConfiguration']['Rules'][0]['Status'] != 'Disabled':
+            replicated.append((i['Name'], bucket_response))
+    return replicated
+
+# Returns the CloudTrail data resource ARNs and the source bucket names.
+# Both are built per call, so a warm container starts from scratch.
+def get_buckets():
     try:
-        list_buckets = client['s3']['handle'].list_buckets()['Buckets']
         crr_buckets = []
-        for i in list_buckets:
-            bucket_response = get_bucket_replication(i['Name'])
-            if 'ReplicationConfigurationError-' != bucket_response \
-                    and bucket_response['ReplicationConfiguration']['Rules'][0]['Status'] != 'Disabled':
-                source_buckets.append(i['Name'])
-                crr_buckets.append(get_source_bucket_arn(i['Name']))
-                crr_buckets.append(get_replica_bucket_arn(bucket_response))
+        source_buckets = []
+        for bucket, bucket_response in get_replicated_buckets():
+            source_buckets.append(bucket)
+            crr_buckets.append(get_source_bucket_arn(bucket))
+            crr_buckets.append(get_replica_bucket_arn(bucket_response))
     except Exception as e:
         print(e)
         raise e
-    return crr_buckets
+    return crr_buckets, source_buckets
 
 def get_source_buckets():
-    print('List Buckets:')
     try:
-        list_buckets = client['s3']['handle'].list_buckets()['Buckets']
-        source_bucket_list = []
-        for i in list_buckets:
-            bucket_response = get_bucket_replication(i['Name'])
-            if 'ReplicationConfigurationError-' != bucket_response \
-                    and bucket_response['ReplicationConfiguration']['Rules'][0]['Status'] != 'Disabled':
-                source_bucket_list.append(i['Name'])
+        source_bucket_list = [ bucket for bucket, bucket_response in get_replicated_buckets() ]
     except Exception as e:
         print(e)
         raise e
@@ -112,11 +136,21 @@ def get_bucket_replication(bucket_name):
         response = client['s3']['handle'].get_bucket_replication(
             Bucket=bucket_name
         )
-    except Exception as e:
-        print(e)
-        response = "ReplicationConfigurationError-"
+    except ClientError as e:
+        # Most buckets have no replication configuration - that is not
+        # worth a log line. Any other error is logged and the bucket is
+        # skipped, as before.
+        if e.response['Error']['Code'] != 'ReplicationConfigurationNotFoundError':
+            print(e)
+        return None
     return response
 
+# Fetch the replication configuration of each bucket in parallel. Results
+# are returned in list_buckets order so callers can zip them back up.
+def get_bucket_replications(list_buckets):
+    with ThreadPoolExecutor(max_workers=bucket_workers) as executor:
+        return list(executor.map(get_bucket_replication, [ i['Name'] for i in list_buckets ]))
+
 def get_source_bucket_arn(response):
     try:
         src_bucket = 'arn:aws:s3:::' + response + '/'
@@ -166,30 +200,36 @@ def put_event_selectors(trail_name,crr_buckets):
 
 def put_metric_alarm(sns_topic, src_buckets):
     print('Metric Alarms:')
-    try:
-        for bucket in src_buckets:
-            client['cloudwatch']['handle'].put_metric_alarm(
-                AlarmName='FailedReplicationAlarm-' + bucket,
-                AlarmDescription='Trigger a alarm for Failed Replication Objects.',
-                ActionsEnabled=True,
-                AlarmActions=[
-                    sns_topic,
-                ],
-                MetricName='FailedReplications',
-                Namespace='CRRMonitor',
-                Statistic='Sum',
-                Dimensions=[
-                    {
-                        'Name': 'SourceBucket',
-                        'Value': bucket
-                    },
-                ],
-                Period=60,
-                EvaluationPeriods=1,
-                Threshold=0.0,
-                ComparisonOperator='GreaterThanThreshold'
 
-            )
+    # CloudWatch has no batch alarm API, so the alarms are created
+    # alarm_workers at a time
+    def put_alarm(bucket):
+        client['cloudwatch']['handle'].put_metric_alarm(
+            AlarmName='FailedReplicationAlarm-' + bucket,
+            AlarmDescription='Trigger a alarm for Failed Replication Objects.',
+            ActionsEnabled=True,
+            AlarmActions=[
+                sns_topic,
+            ],
+            MetricName='FailedReplications',
+            Namespace='CRRMonitor',
+            Statistic='Sum',
+            Dimensions=[
+                {
+                    'Name': 'SourceBucket',
+                    'Value': bucket
+                },
+            ],
+            Period=60,
+            EvaluationPeriods=1,
+            Threshold=0.0,
+            ComparisonOperator='GreaterThanThreshold'
+
+        )
+
+    try:
+        with ThreadPoolExecutor(max_workers=alarm_workers) as executor:
+            list(executor.map(put_alarm, src_buckets))
     except Exception as e:
         print(e)
         print('Data Events Trail')
@@ -197,22 +237,23 @@ def put_metric_alarm(sns_topic, src_buckets):
 
 def put_metric_data(src_buckets):
     print('Metric Data: ')
+    metric_data = [
+        {
+            'MetricName': 'FailedReplications',
+            'Dimensions': [
+                {
+                    'Name': 'SourceBucket',
+                    'Value': bucket
+                },
+            ],
+            'Value': 0.0
+        } for bucket in src_buckets
+    ]
     try:
-        for bucket in src_buckets:
+        for n in range(0, len(metric_data), metric_batch):
             client['cloudwatch']['handle'].put_metric_data(
                 Namespace='CRRMonitor',
-                MetricData=[
-                    {
-                        'MetricName': 'FailedReplications',
-                        'Dimensions': [
-                            {
-                                'Name': 'SourceBucket',
-                                'Value': bucket
-                            },
-                        ],
-                        'Value': 0.0
-                    },
-                ]
+                MetricData=metric_data[n:n + metric_batch]
             )
     except Exception as e:
         print(e)
@@ -233,7 +274,7 @@ def create_trail_alarm(event, context):
     ### Trail Creation
 
     create_trail(trail_name, trail_log_bucket)
-    crr_buckets = get_buckets()
+    crr_buckets, source_buckets = get_buckets()
     put_event_selectors(trail_name, crr_buckets)
 
     ### Metric Alarm
@@ -265,17 +306,10 @@ def delete_trail_alarm(event, context):
     trail_name = event["ResourceProperties"]["trail_name"] # Trail Name
     print("Delete TrailName:" + trail_name)
     # -----------------------------------------------------------------
-    # Create client connections
+    # Use the client connections made at load time
     #
-    # events
-    try:
-        ctl = boto3.client('cloudtrail')
-        cwe = boto3.client('cloudwatch')
-
-    except Exception as e:
-        print(e)
-        print('Error creating Events client')
-        raise e
+    ctl = client['cloudtrail']['handle']
+    cwe = client['cloudwatch']['handle']
 
     # -----------------------------------------------------------------
     # Remove the Targets
@@ -286,11 +320,10 @@ def delete_trail_alarm(event, context):
 
     ###Fetching source bucket details
     source_bucket_list = get_source_buckets()
-    for bucket in source_bucket_list:
+    alarm_names = [ 'FailedReplicationAlarm-' + bucket for bucket in source_bucket_list ]
+    for n in range(0, len(alarm_names), alarm_batch):
         cwe.delete_alarms(
-            AlarmNames=[
-                'FailedReplicationAlarm-' + bucket,
-            ]
+            AlarmNames=alarm_names[n:n + alarm_batch]
         )
 
     return {}
@@ -17,15 +17,20 @@
 import json
 import logging
 import sys
-if sys.version_info.major == 3:
-    from urllib.request import urlopen, Request, HTTPError, URLError
-    from urllib.parse import urlencode
-else:
-    from urllib2 import urlopen, Request, HTTPError, URLError
+import urllib3
+PY3 = sys.version_info.major == 3
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Connection pool for the CFN response PUTs. It lives at module level so a
+# warm container reuses the TLS connection across callbacks.
+http = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=4,
+    retries=urllib3.Retry(3, backoff_factor=0.2)
+)
+
 SUCCESS = 'SUCCESS'
 FAILED = 'FAILED'
 
@@ -56,7 +61,8 @@ def wrap_user_handler(func, base_response=None):
         if base_response is not None:
             response.update(base_response)
 
-        logger.debug("Received %s request with event: %s" % (event['RequestType'], json.dumps(event)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received %s request with event: %s" % (event['RequestType'], json.dumps(event)))
 
         try:
             response.update(func(event, context))
@@ -71,25 +77,24 @@ def wrap_user_handler(func, base_response=None):
         logger.info("Responding to '%s' request with: %s" % (
             event['RequestType'], serialized))
 
-        if sys.version_info.major == 3:
+        if PY3:
             req_data = serialized.encode('utf-8')
         else:
             req_data = serialized
-        req = Request(
-            event['ResponseURL'], data=req_data,
-            headers={'Content-Length': len(req_data),
-                     'Content-Type': ''}
-        )
-        req.get_method = lambda: 'PUT'
 
         try:
-            urlopen(req)
-            logger.debug("Request to CFN API succeeded, nothing to do here")
-        except HTTPError as e:
-            logger.error("Callback to CFN API failed with status %d" % e.code)
-            logger.error("Response: %s" % e.reason)
-        except URLError as e:
-            logger.error("Failed to reach the server - %s" % e.reason)
+            r = http.request(
+                'PUT', event['ResponseURL'], body=req_data,
+                headers={'Content-Length': str(len(req_data)),
+                         'Content-Type': ''}
+            )
+            if r.status >= 400:
+                logger.error("Callback to CFN API failed with status %d" % r.status)
+                logger.error("Response: %s" % r.reason)
+            else:
+                logger.debug("Request to CFN API succeeded, nothing to do here")
+        except urllib3.exceptions.HTTPError as e:
+            logger.error("Failed to reach the server - %s" % e)
 
     return wrapper_func
 
@@ -99,11 +104,18 @@ class Resource(object):
     def __init__(self, wrapper=wrap_user_handler):
         self._dispatch = {}
         self._wrapper = wrapper
+        # Used for request types with no registered handler. Built once
+        # here rather than on every call.
+        self._fallback = self._succeed()
 
     def __call__(self, event, context):
         request = event['RequestType']
-        logger.debug("Received {} type event. Full parameters: {}".format(request, json.dumps(event)))
-        return self._dispatch.get(request, self._succeed())(event, context)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received {} type event. Full parameters: {}".format(request, json.dumps(event)))
+        handler = self._dispatch.get(request)
+        if handler is None:
+            handler = self._fallback
+        return handler(event, context)
 
     def _succeed(self):
         @self._wrapper
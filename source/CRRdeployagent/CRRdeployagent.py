@@ -17,99 +17,215 @@
 from __future__ import print_function
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 # Unable to import module? You need to zip CRRdeployagent.py with
 # cfn_resource.py!!
 import cfn_resource
 import json
+import threading
+import os
+import time
 
 handler = cfn_resource.Resource()
 
-source_buckets = []
-
+# DEBUG: set the debug environment variable to 1 or more to log each
+# region and bucket step. Errors are always logged.
+try:
+    DEBUG = int(os.environ.get('debug', 0))
+except ValueError:
+    print('Environmental variable \'debug\' is not an integer. Using default [0]')
+    DEBUG = 0
+
+# CloudWatch Events pattern for the agent rule: S3 object writes seen by
+# CloudTrail
+EVENT_PATTERN = json.dumps({
+    "detail-type": [ "AWS API Call via CloudTrail" ],
+    "detail": {
+        "eventSource": [ "s3.amazonaws.com" ],
+        "eventName": [ "PutObject", "CopyObject", "CompleteMultipartUpload" ]
+    }
+})
+
+# Per-bucket S3 calls are made bucket_workers at a time
+bucket_workers = 32
+# Agent regions are created or deleted region_workers at a time
+region_workers = 32
+
+# client_config: botocore config shared by all clients. Keep-alive and a
+# connection pool larger than bucket_workers let the worker threads reuse
+# connections instead of queueing on the pool or re-doing TLS handshakes.
+client_config = Config(
+    max_pool_connections=50,
+    retries={'max_attempts': 5, 'mode': 'adaptive'}
+)
+# tcp_keepalive needs botocore >= 1.27. Older versions reject the option;
+# they still reuse pooled HTTP/1.1 connections, just without TCP keep-alive.
 try:
-    sts = boto3.client('sts')
-    ec2 = boto3.client('ec2')
-except Exception as e:
-    print(e)
-    print('Error creating sts and ec2 clients')
-    raise e
+    client_config = client_config.merge(Config(tcp_keepalive=True))
+except TypeError:
+    print('botocore does not support tcp_keepalive - continuing without it')
 
-local_account = sts.get_caller_identity()['Account']
+# =====================================================================
+# get_client
+# ----------
+# Return the client for a service (and optionally a region). Each client
+# is created on first use and cached for the life of the Lambda
+# container. All clients come from one session, so the credential chain
+# is resolved once. Creation is serialized because a boto3 session is
+# not thread safe, and regions are handled on several threads.
+# =====================================================================
+session = boto3.session.Session()
+client_lock = threading.Lock()
 
-# Create a hash of regions
-REGIONSEL = {}
+@lru_cache(maxsize=None)
+def get_client(service, region=None):
+    with client_lock:
+        try:
+            return session.client(service, region_name=region, config=client_config)
+        except Exception as e:
+            print(e)
+            print('Error connecting to ' + service)
+            raise e
 
-response = ec2.describe_regions()
+# =====================================================================
+# get_local_account / get_region_sel
+# ----------------------------------
+# The account id and the hash of regions are looked up on first use and
+# cached for the life of the container. DELETE does not need either, so
+# nothing is called at load time.
+# =====================================================================
+@lru_cache(maxsize=1)
+def get_local_account():
+    # The template sets AWS_STS_REGIONAL_ENDPOINTS=regional, so this uses
+    # STS in the function's own region (and partition) rather than the
+    # global endpoint
+    return get_client('sts', session.region_name).get_caller_identity()['Account']
+
+@lru_cache(maxsize=1)
+def get_region_sel():
+    ec2 = get_client('ec2')
+
+    # Create a hash of regions
+    regionsel = {}
 
-for region in response['Regions']:
+    response = ec2.describe_regions()
 
-    REGIONSEL[region['RegionName']] = 0
+    for region in response['Regions']:
+
+        regionsel[region['RegionName']] = 0
+
+    return regionsel
 
 ###########Get Buckets and Agent Region #################
 
+# Returns the regions of the source buckets and the list of replica
+# buckets. A source bucket's region is looked up by the same worker that
+# found its replication configuration, so no second pass is needed.
 def get_replica_buckets(client):
-    print('List Replica Buckets:')
+    if DEBUG:
+        print('List Replica Buckets:')
+
+    def check_bucket(i):
+        bucket_response = get_bucket_replication(i['Name'], client)
+        if bucket_response is not None \
+                and bucket_response['ReplicationConfiguration']['Rules'][0]['Status'] != 'Disabled':
+            return bucket_response, get_bucket_region(i['Name'], client)
+        return None, None
+
     try:
         list_buckets = client.list_buckets()['Buckets']
         replica_buckets = []
-        for i in list_buckets:
-            bucket_response = get_bucket_replication(i['Name'], client)
-            if 'ReplicationConfigurationError-' != bucket_response \
-                    and bucket_response['ReplicationConfiguration']['Rules'][0]['Status'] != 'Disabled':
-                source_buckets.append(i['Name'])
+        source_regions = set([])
+        with ThreadPoolExecutor(max_workers=bucket_workers) as executor:
+            bucket_results = list(executor.map(check_bucket, list_buckets))
+        for i, (bucket_response, region) in zip(list_buckets, bucket_results):
+            if bucket_response is not None:
+                if region is not None:
+                    source_regions.add(region)
                 dest_bucket_arn = bucket_response['ReplicationConfiguration']['Rules'][0]['Destination']['Bucket']
                 replica_buckets.append(dest_bucket_arn.split(':', 5)[5])
     except Exception as e:
         print(e)
         raise e
-    return replica_buckets
+    return source_regions, replica_buckets
 
 def get_bucket_replication(bucket_name, client):
     try:
         response = client.get_bucket_replication(
             Bucket=bucket_name
         )
+    except ClientError as e:
+        # Most buckets have no replication configuration - that is not
+        # worth a log line. Any other error is logged and the bucket is
+        # skipped, as before.
+        if e.response['Error']['Code'] != 'ReplicationConfigurationNotFoundError':
+            print(e)
+        return None
+    return response
+
+# head_bucket results are kept for bucket_region_ttl seconds, the same
+# as the agent regions. A bucket deleted and re-created in another region
+# is then seen in its new region by a later invocation of a warm
+# container. get_bucket_region runs on worker threads.
+bucket_region_ttl = 60
+bucket_region_cache = {}
+bucket_region_lock = threading.Lock()
+
+def get_bucket_region(bucket, client):
+    now = time.time()
+    with bucket_region_lock:
+        cached = bucket_region_cache.get(bucket)
+    if cached is not None and now - cached[0] < bucket_region_ttl:
+        return cached[1]
+    try:
+        response = client.head_bucket(
+            Bucket=bucket
+        )
+        region = response['ResponseMetadata']['HTTPHeaders']['x-amz-bucket-region']
+        if region == None:
+            region = 'us-east-1'
+        with bucket_region_lock:
+            bucket_region_cache[bucket] = (now, region)
+        return region
     except Exception as e:
+        print('Unable to get region for bucket ' + bucket)
         print(e)
-        response = "ReplicationConfigurationError-"
-    return response
+        return None
 
 #Gets the list of agent regions for Agent deployment
+#
+# The result is reused for agent_regions_ttl seconds. A warm container
+# invoked again right away (a retried or repeated request) sees the same
+# bucket topology, so the S3 walk is skipped.
+agent_regions_ttl = 60
+agent_regions_cache = {}
 
 def get_agent_regions():
-    try:
-        client = boto3.client('s3')
-        replica_buckets = get_replica_buckets(client)
-        agent_set = set([])
-        for bucket in replica_buckets:
-            try:
-                response = client.head_bucket(
-                    Bucket=bucket
-                )
-                region = response['ResponseMetadata']['HTTPHeaders']['x-amz-bucket-region']
-                if region == None:
-                    region = 'us-east-1'
-                agent_set.add(region)
-            except Exception as e:
-                print('Unable to get region for bucket ' + bucket)
-                print(e)
+    now = time.time()
+    cached = agent_regions_cache.get('regions')
+    if cached is not None and now - cached[0] < agent_regions_ttl:
+        return cached[1]
+    agent_regions = find_agent_regions()
+    agent_regions_cache['regions'] = (now, agent_regions)
+    return agent_regions
 
-        for bucket in source_buckets:
-            try:
-                response = client.head_bucket(
-                    Bucket=bucket
-                )
-                region = response['ResponseMetadata']['HTTPHeaders']['x-amz-bucket-region']
-                if region == None:
-                    region = 'us-east-1'
-                agent_set.add(region)
-            except Exception as e:
-                print('Unable to get region for bucket ' + bucket)
-                print(e)
+def find_agent_regions():
+    try:
+        client = get_client('s3')
+        agent_set, replica_buckets = get_replica_buckets(client)
+        # Only the replica buckets still need a region. One that is also a
+        # source bucket is answered from bucket_region_cache.
+        with ThreadPoolExecutor(max_workers=bucket_workers) as executor:
+            regions = list(executor.map(lambda b: get_bucket_region(b, client), dict.fromkeys(replica_buckets)))
+        agent_set.update([ r for r in regions if r is not None ])
 
         agent_regions = list(agent_set)
-        print('get_agent_regions: agent_regions = ')
-        print(*agent_regions, sep = "\n")
+        if DEBUG:
+            print('get_agent_regions: agent_regions = ')
+            print(*agent_regions, sep = "\n")
     except Exception as e:
         print(e)
         raise e
@@ -130,7 +246,8 @@ def create_agent(event, context):
     # - MyAccountId
     # - CRRMonitorAccount
     #
-    print(json.dumps(event))
+    if DEBUG:
+        print(json.dumps(event))
     monitor_account = ''
     topic_name = ''
     queue_arn = ''
@@ -154,14 +271,47 @@ def create_agent(event, context):
     physical_resource_id = {'PhysicalResourceId': 'CRRMonitorAgent-Deployed'}
 
     # Configure each region for monitoring based on what we found.
-    for region in REGIONSEL:
+    # Regions are independent, so they are configured region_workers at
+    # a time. Any failure is re-raised here and fails the request.
+    def deploy(region):
 
-        print('Deploying in ' + region)
+        if DEBUG:
+            print('Deploying in ' + region)
 
         agent_creator(region, topic_name, queue_arn, monitor_account, agent_accounts)
 
+    with ThreadPoolExecutor(max_workers=region_workers) as executor:
+        list(executor.map(deploy, get_region_sel()))
+
     return physical_resource_id
 
+# True if the agent rule already exists, is enabled, and matches
+# EVENT_PATTERN, so put_rule and enable_rule can be skipped.
+def rule_is_current(cwe, rule):
+    try:
+        response = cwe.describe_rule(Name=rule)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            print(e)
+        return False
+    if response.get('State') != 'ENABLED' or response.get('EventPattern') is None:
+        return False
+    return json.loads(response['EventPattern']) == json.loads(EVENT_PATTERN)
+
+# Return the statement ids in the default event bus policy. put_permission
+# takes a single statement per call; a Policy document would replace the
+# whole bus policy, including statements this stack did not create.
+def get_event_bus_statements(cwe):
+    try:
+        policy = cwe.describe_event_bus().get('Policy')
+    except Exception as e:
+        print(e)
+        print('Unable to read the default event bus policy')
+        return set([])
+    if policy is None:
+        return set([])
+    return set([ stmt.get('Sid') for stmt in json.loads(policy).get('Statement', []) ])
+
 def agent_creator(agt_region, topic_name, queue_arn, monitor_account, agent_accounts):
 
     rule = 'CRRRemoteAgent'
@@ -169,32 +319,39 @@ def agent_creator(agt_region, topic_name, queue_arn, monitor_account, agent_acco
     if not monitor_account:
         rule = 'CRRAgent'
 
-    boto3.setup_default_session(region_name=agt_region)
     # -----------------------------------------------------------------
     # Create client connections
     #
+    # Clients are scoped to agt_region explicitly. Regions run on worker
+    # threads, so the default session must not be changed.
     try:
-        cwe = boto3.client('events')
-        sns = boto3.client('sns')
+        cwe = get_client('events', agt_region)
+        sns = get_client('sns', agt_region)
     except Exception as e:
         print(e)
         print('Error creating clients for ' + agt_region)
         raise e
 
-    try:
-        cwe.put_rule(
-            Description='Fires CRRMonitor for S3 events that indicate an object has been stored.',
-            Name=rule,
-            EventPattern="{ \"detail-type\": [ \"AWS API Call via CloudTrail\" ], \"detail\": { \"eventSource\": [ \"s3.amazonaws.com\"], \"eventName\": [ \"PutObject\", \"CopyObject\", \"CompleteMultipartUpload\" ] } }",
-            State='DISABLED'
-        )
-    except Exception as e:
-        print(e)
-        print('Error creating CW Event rule')
-        raise e
+    # A redeploy usually finds the rule already enabled with this pattern.
+    # Leave it alone then; put_rule would disable it until enable_rule.
+    rule_current = rule_is_current(cwe, rule)
+
+    if not rule_current:
+        try:
+            cwe.put_rule(
+                Description='Fires CRRMonitor for S3 events that indicate an object has been stored.',
+                Name=rule,
+                EventPattern=EVENT_PATTERN,
+                State='DISABLED'
+            )
+        except Exception as e:
+            print(e)
+            print('Error creating CW Event rule')
+            raise e
 
     if not monitor_account:
-        print('Creating agent for a monitor/agent account in region ' + agt_region)
+        if DEBUG:
+            print('Creating agent for a monitor/agent account in region ' + agt_region)
         topic = topic_name + "-" + agt_region
 
         # -----------------------------------------------------------------
@@ -207,32 +364,44 @@ def agent_creator(agt_region, topic_name, queue_arn, monitor_account, agent_acco
         # Enable the rule
         try:
 
-            topicarn = sns.create_topic(Name=topic)['TopicArn']
-            sns.set_topic_attributes(
-                TopicArn=topicarn,
-                AttributeName='Policy',
-                AttributeValue='{\
-            "Version": "2012-10-17",\
-            "Id": "CWEventPublishtoTopic",\
-            "Statement": [\
-                {\
-                  "Sid": "CWEventPublishPolicy",\
-                  "Action": [\
-                    "SNS:Publish"\
-                  ],\
-                  "Effect": "Allow",\
-                  "Resource": "' + topicarn + '",\
-                  "Principal": {\
-                    "Service": [\
-                      "events.amazonaws.com"\
-                    ]\
-                  }\
-                }\
-              ]\
-            }\
-                    ',
-
-            )
+            # The topic ARN is fixed by region, account and name. Read the
+            # topic's policy directly, create the topic only if it does not
+            # exist yet, and set the policy only if it differs.
+            topicarn = 'arn:aws:sns:' + agt_region + ':' + get_local_account() + ':' + topic
+            topic_policy = json.dumps({
+                "Version": "2012-10-17",
+                "Id": "CWEventPublishtoTopic",
+                "Statement": [
+                    {
+                        "Sid": "CWEventPublishPolicy",
+                        "Action": [
+                            "SNS:Publish"
+                        ],
+                        "Effect": "Allow",
+                        "Resource": topicarn,
+                        "Principal": {
+                            "Service": [
+                                "events.amazonaws.com"
+                            ]
+                        }
+                    }
+                ]
+            })
+            try:
+                current_policy = sns.get_topic_attributes(
+                    TopicArn=topicarn
+                )['Attributes'].get('Policy')
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NotFound':
+                    raise e
+                topicarn = sns.create_topic(Name=topic)['TopicArn']
+                current_policy = None
+            if current_policy is None or json.loads(current_policy) != json.loads(topic_policy):
+                sns.set_topic_attributes(
+                    TopicArn=topicarn,
+                    AttributeName='Policy',
+                    AttributeValue=topic_policy
+                )
             cwe.put_targets(
                 Rule=rule,
                 Targets=[
@@ -242,7 +411,8 @@ def agent_creator(agt_region, topic_name, queue_arn, monitor_account, agent_acco
                     }
                 ]
             )
-            cwe.enable_rule(Name=rule)
+            if not rule_current:
+                cwe.enable_rule(Name=rule)
         except Exception as e:
             print(e)
             print('Error creating SNS topic and CW Event rule: ' + topic)
@@ -264,8 +434,12 @@ def agent_creator(agt_region, topic_name, queue_arn, monitor_account, agent_acco
             print('Error subscribing SNS topic ' + topic + ' to SQS Queue ' + queue_arn)
             raise e
 
-        # Grant permissions to the default event bus
+        # Grant permissions to the default event bus. Accounts that already
+        # have a statement (from an earlier deploy) are skipped.
+        granted = get_event_bus_statements(cwe)
         for account in agent_accounts:
+            if account in granted:
+                continue
             try:
                 cwe.put_permission(
                     Action='events:PutEvents',
@@ -283,7 +457,8 @@ def agent_creator(agt_region, topic_name, queue_arn, monitor_account, agent_acco
             }
 
     else:
-        print('Creating agent for an agent-only account in region ' + agt_region)
+        if DEBUG:
+            print('Creating agent for an agent-only account in region ' + agt_region)
         try:
             cwe.put_targets(
                 Rule=rule,
@@ -294,7 +469,8 @@ def agent_creator(agt_region, topic_name, queue_arn, monitor_account, agent_acco
                     }
                 ]
             )
-            cwe.enable_rule(Name=rule)
+            if not rule_current:
+                cwe.enable_rule(Name=rule)
         except Exception as e:
             print(e)
             print('Error creating CW Event target')
@@ -347,8 +523,8 @@ def delete_agent(event, context):
     # Get a list of regions where we have source or replica buckets
     agent_regions = get_agent_regions()
 
-    for region in agent_regions:
-        agent_deleter(region, topic_name, queue_arn, monitor_account, agent_accounts)
+    with ThreadPoolExecutor(max_workers=region_workers) as executor:
+        list(executor.map(lambda region: agent_deleter(region, topic_name, queue_arn, monitor_account, agent_accounts), agent_regions))
 
     return {}
 
@@ -357,14 +533,13 @@ def agent_deleter(agt_region, topic_name, queue_arn, monitor_account, agent_acco
     #
     # Deletion has to occur in a specific order
     #
-    boto3.setup_default_session(region_name=agt_region)
     # -----------------------------------------------------------------
     # Create client connections
     #
     try:
-        cwe = boto3.client('events')
+        cwe = get_client('events', agt_region)
         if not monitor_account:
-            sns = boto3.client('sns')
+            sns = get_client('sns', agt_region)
     except Exception as e:
         print(e)
         print('Error creating Events client for ' + agt_region)
@@ -396,12 +571,12 @@ def agent_deleter(agt_region, topic_name, queue_arn, monitor_account, agent_acco
     # For Manager/Agent account, remove the SNS topic
     if not monitor_account:
         topic = topic_name + "-" + agt_region
-        print("Delete " + topic + " in " + agt_region)
+        if DEBUG:
+            print("Delete " + topic + " in " + agt_region)
         # -----------------------------------------------------------------
         # RequestType Delete
         #
-        sts = boto3.client('sts')
-        myaccount = sts.get_caller_identity()['Account']
+        myaccount = get_local_account() # looked up once, not per region
         topicarn = 'arn:aws:sns:' + agt_region + ':' + myaccount + ':' + topic
         # Delete the SNS topic
         sns.delete_topic(
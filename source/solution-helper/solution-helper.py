@@ -17,8 +17,11 @@
 # solution-helper.py
 # This code generates a uuid using the uuid random tool
 import json 
-import uuid 
-import urllib.request
+import urllib3
+
+# Kept for the life of the container so a warm invocation reuses the
+# connection for the CFN response
+http = urllib3.PoolManager(maxsize=4, retries=urllib3.Retry(total=3))
  
 def send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False): 
     try: 
@@ -42,9 +45,8 @@ def send(event, context, responseStatus, responseData, physicalResourceId=None,
             'content-length' : str(len(data)) 
         } 
  
-        req = urllib.request.Request(url=responseUrl, data=data, method='PUT', headers=headers)
-        with urllib.request.urlopen(req) as f:
-            print(f"CFN Status: {f.status}")
+        r = http.request('PUT', responseUrl, body=data, headers=headers)
+        print(f"CFN Status: {r.status}")
     except Exception as e: 
         raise(e) 
 
@@ -54,6 +56,8 @@ def lambda_handler(event, context):
         responseData = {} 
  
         if request == 'Create': 
+            # uuid is only needed here, so it is not imported at load time
+            import uuid
             responseData = {'UUID':str(uuid.uuid4())} 
  
         send(event, context, 'SUCCESS', responseData) 